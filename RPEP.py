@@ -13,11 +13,38 @@ Special thanks to Dr. Zhang Chen for reviewing this code and providing me very u
 
 Note: works (best) in the Psychopy application or in Python 3.8 or lower
 """
-import pandas
 import math
 import random
 import os
-from psychopy import visual, data, gui, core, event
+import sys
+import argparse
+import array
+import atexit
+import contextlib
+import csv
+import gzip
+import heapq
+import io
+import json
+import queue
+import platform
+import statistics
+import threading
+import _thread
+import time
+from types import SimpleNamespace
+from collections import Counter, OrderedDict, deque
+# Only the light psychopy clock is imported at startup; pandas, numpy and the psychopy modules that need a display
+# (visual, event, gui) are imported where they are first used
+from psychopy import core
+
+# Columns of a trial that depend on its condition (see TrialTable) -> index in the condition
+CONDITION_COLUMNS = {"shape_name": 0, "correct_response": 1, "color": 2, "incentive": 3}
+# Soup colors (which 2 are used in which block differs per participant)
+COLORS = ["purple", "blue", "yellow", "pink"]
+# Positions of the 7 garnish shapes on the soup (pix on a screen of GARNISH_HEIGHT pix high; scaled to the window)
+GARNISH_POS = [(0, 0), (-90, 10), (-40, 120), (100, -100), (20, -80), (-100, -100), (60, 80)]
+GARNISH_HEIGHT = 1080
 
 # _____ FUNCTIONS _____ #
 def star_shape_maker(size, n_points=5, inner_circle=2.0) -> list:
@@ -41,6 +68,7 @@ def info_GUI() -> tuple:
     Asks number, gender and age of participant
     :return: tuple of participant number, gender and age
     """
+    from psychopy import gui
     info = {
         "Nummer": "",
         "Leeftijd": "",
@@ -58,37 +86,51 @@ def info_GUI() -> tuple:
     return info["Nummer"], info["Gender"], info["Leeftijd"], info["Leidt u aan kleurenblindheid?"]
 
 
-# For testing/debugging
-def trial_runner_devstats(trial, feedback, accuracy, response, response_time):
-    print(
-        f"{'Stimulus':20s} | {trial['color']} {trial['shape_name'].capitalize()}\n"
-        f"{'Given Response':20s} | {'Go' if response else 'NoGo'}\n"
-        f"{'Correct Response':20s} | {trial['correct_response']}\n",
-        f"{'-> Accuracy':20s} = {int(accuracy)} (Time: {response_time if response_time <= 1 else '/'})\n\n",
-        f"Given feedback: '{feedback[0]}'",
-        f"\n",
-        f"Interpretation:\n",
-        f"\t {'Feedback should be':20s}| {trial['incentive'].capitalize()} {('received' if accuracy else 'missed') if trial['incentive'] == 'reward' else ('avoided' if accuracy else 'received')}\n",
-        f"\t {'Given feedback':20s}| {trial['incentive'].capitalize()} {('received' if feedback == '↑' else 'missed') if trial['incentive'] == 'reward' else ('avoided' if feedback == '-' else 'received')}\n",
-        f"{'_' * 50}\n",
-        sep="")
-
-
-# For testing/debugging
-def trial_maker_devstats(trials, trial_list):
-    data_frame = pandas.DataFrame.from_dict(trials.trialList)
-    print(
-        f"{'_' * 20}\n"
-        f"TABLE OF CREATED TRIALS\n\n",
-        pandas.crosstab(data_frame["incentive"], data_frame["correct_response"]),
-        f"\n{'_' * 20}\n"
-    )
-    print(f"LIST OF CREATED TRIALS\n")
-    for trial_i, trial in enumerate(trial_list):
-        print(trial_i + 1, trial, "\n")
-        if not (trial_i + 1) % 8:
-            print("__________________\n")
-    print(f"{'_' * 30}\n")
+# For testing/debugging: readable text of an entry of OnlineStats (also used by RPEP_monitor.py)
+def format_stats(entry: dict) -> str:
+    if entry["type"] == "block":
+        lines = [f"{'_' * 20}", f"TABLE OF CREATED TRIALS ({entry['block_type']})\n", f"{'incentive':12s} {'Go':>5} {'NoGo':>5}"]
+        for incentive in ("punishment", "reward"):
+            lines.append(f"{incentive:12s} {entry['crosstab'].get(incentive + '/Go', 0):5d} {entry['crosstab'].get(incentive + '/NoGo', 0):5d}")
+        lines += [f"{'_' * 20}\n", "LIST OF CREATED TRIALS\n"]
+        for trial_i, trial in enumerate(entry["trials"]):
+            lines.append(f"{trial_i + 1} {trial}" + ("\n__________________" if not (trial_i + 1) % 8 else ""))
+        return "\n".join(lines) + f"\n{'_' * 30}\n"
+
+    last = entry["last"]
+    lines = [
+        f"Trial {entry['n_trials']:3d} | {last['color']} {last['shape_name'].capitalize()} | {last['given_response']} "
+        f"(correct: {last['correct_response']}) -> accuracy {last['accuracy']}, feedback {last['feedback']} "
+        f"(time: {'/' if last['response_time'] is None else round(last['response_time'], 3)})"
+    ]
+    lines += [f"  {'accuracy':10s}{cell:32s}{accuracy:.2f}" for cell, accuracy in sorted(entry["accuracy"].items())]
+    lines += [f"  {'go bias':10s}{block_type:32s}{'/' if bias is None else f'{bias:+.2f}'}" for block_type, bias in sorted(entry["go_bias"].items())]
+    for cell, rt in sorted(entry["response_time"].items()):
+        sd = "/" if rt["sd"] is None else f"{rt['sd']:.3f}"
+        lines.append(f"  {'rt':10s}{cell:32s}{rt['mean']:.3f} ± {sd} (n={rt['n']})")
+    return "\n".join(lines) + f"\n{'_' * 50}\n"
+
+
+def check_answer(question: int, answer: str, correct_answer: str) -> bool:
+    """
+    Checks if the answer to one question of the questionnaire is correct
+    :param question: Index of the question (0: punishment color, 1: Go shape, 2: meaning of Go)
+    :param answer: Given answer (by mouse click)
+    :param correct_answer: Correct answer (random every experiment)
+    :return: True if correct, else False
+    """
+    color_translation = {
+        "Paars": "purple",
+        "Geel": "yellow",
+        "Roze": "pink",
+        "Blauw": "blue"
+    }
+    if question == 0:
+        return color_translation[answer] == correct_answer
+    if question == 1:
+        return answer.lower() == correct_answer
+    return (answer == "Je neemt de soep mee" and correct_answer == "congruent" or
+            answer == "Je gooit de soep weg" and correct_answer == "incongruent")
 
 
 def check_correct(answers, correct_answers) -> bool:
@@ -98,43 +140,117 @@ def check_correct(answers, correct_answers) -> bool:
     :param correct_answers: Correct answers (random every experiment)
     :return:
     """
-    color_translation = {
-        "Paars": "purple",
-        "Geel": "yellow",
-        "Roze": "pink",
-        "Blauw": "blue"
-    }
-    check1 = color_translation[answers[0]] == correct_answers[0]
-    check2 = answers[1].lower() == correct_answers[1]
-    check3 = (answers[2] == "Je neemt de soep mee" and correct_answers[2] == "congruent" or
-              answers[2] == "Je gooit de soep weg" and correct_answers[2] == "incongruent")
-    return check1 and check2 and check3
+    return all(check_answer(question, answer, correct_answer)
+               for question, (answer, correct_answer) in enumerate(zip(answers, correct_answers)))
+
+
+class TrialTable:
+    COLUMNS = ("block_type", "shape_name", "correct_response", "color", "incentive", "fix_cross_frames", "order_per_8")
+
+    def __init__(self, block_type: str, conditions: list, position, fix_cross_frames):
+        """
+        Trials of one block in compact form: 1 byte (position within the mini-block of 8) and 2 bytes (fixation frames)
+        per trial; everything else follows from the position. Iterating gives Trial records (read like the trial dicts)
+        :param block_type: Congruent or incongruent (same for every trial)
+        :param conditions: For each position (0-7): shape_name, correct_response, color and incentive
+        :param position: Position of every trial within its mini-block of 8 (before shuffling)
+        :param fix_cross_frames: Fixation duration of every trial (frames)
+        """
+        self.block_type = block_type
+        self.conditions = [tuple(condition) for condition in conditions]
+        self.position = bytes(position)
+        self.fix_cross_frames = array.array("H", fix_cross_frames)
+
+    def __len__(self) -> int:
+        return len(self.position)
+
+    def __getitem__(self, index: int):
+        if not -len(self) <= index < len(self):
+            raise IndexError(index)
+        return Trial(self, index % len(self))
+
+    def __iter__(self):
+        return (Trial(self, index) for index in range(len(self)))
+
+    def columns(self) -> dict:
+        """
+        :return: dictionary of column (COLUMNS) -> list of values, as in the datafile
+        """
+        conditions = [self.conditions[position] for position in self.position]
+        columns = {"block_type": [self.block_type] * len(self)}
+        for i, column in enumerate(CONDITION_COLUMNS):
+            columns[column] = [condition[i] for condition in conditions]
+        columns["fix_cross_frames"] = self.fix_cross_frames.tolist()
+        columns["order_per_8"] = [(position + 1) % 8 + 1 for position in self.position]
+        return columns
+
+
+class Trial:
+    __slots__ = ("table", "index")
+
+    def __init__(self, table: TrialTable, index: int):
+        """
+        One trial of a TrialTable: trial["color"] etc. as with the trial dicts; {**trial} gives the dict
+        """
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, column: str):
+        table = self.table
+        if column == "fix_cross_frames":
+            return table.fix_cross_frames[self.index]
+        if column == "block_type":
+            return table.block_type
+        if column == "order_per_8":
+            return (table.position[self.index] + 1) % 8 + 1  # Original order (before randomization, per 8)
+        return table.conditions[table.position[self.index]][CONDITION_COLUMNS[column]]
+
+    def keys(self) -> tuple:
+        return TrialTable.COLUMNS
+
+    def __repr__(self) -> str:
+        return repr({column: self[column] for column in self.keys()})
 
 
 class Questionnaire:
     def __init__(self, window, main_exp):
         """
         Asks questions to participant to check whether they read the instructions
+        Everything on the three question pages is laid out once; asking only draws, flips and checks the mouse once per frame
         :param window:
         :param main_exp:
         """
         self.win = window
         self.main_exp = main_exp
+        visual = main_exp.visual
 
         self.positions = [(-0.475, 0), (0.475, 0), (-0.475, -0.3), (0.475, -0.3)]
-        self.buttons = {
-            "1": visual.Rect(self.win, size=(0.85, 0.175), fillColor="lightblue", lineColor="black"),
-            "2": visual.Rect(self.win, size=(0.85, 0.175), fillColor="lightblue", lineColor="black"),
-            "3": visual.Rect(self.win, size=(0.85, 0.175), fillColor="lightblue", lineColor="black"),
-            "4": visual.Rect(self.win, size=(0.85, 0.175), fillColor="lightblue", lineColor="black")
-        }
+        size = (0.85, 0.175)
+        self.buttons = [
+            visual.Rect(self.win, size=size, pos=pos, fillColor="lightblue", lineColor="black") for pos in self.positions
+        ]
+        # Clickable area of each button (norm units): left, bottom, right, top
+        self.hit_boxes = [
+            (x - size[0] / 2, y - size[1] / 2, x + size[0] / 2, y + size[1] / 2) for x, y in self.positions
+        ]
         self.answers = [
             ["Roze", "Geel", "Paars", "Blauw"], ["Driehoeken", "Vierkanten", "Cirkels" ,"Sterren"],
             ["Je krijgt een beloning", "Je gooit de soep weg", "Je neemt de soep mee", "Je laat de soep staan"]
         ]
+        self.labels = [
+            [visual.TextStim(self.win, text=answer, pos=pos, height=0.1, color="black") for pos, answer in zip(self.positions, answers)]
+            for answers in self.answers
+        ]
+        self.questions = {
+            block_type: [main_exp.message_stim(f"question{i + 1}", pos=(0, 0.4), size=0.1, block_type=block_type)
+                         for i in range(len(self.answers))]
+            for block_type in ("congruent", "incongruent")
+        }
 
-        self.button_message = visual.TextStim(self.win, height=0.1, color="black")
-        self.mouse = event.Mouse(win=self.win, visible=False)
+        self.mouse = main_exp.backend.mouse(self.win)  # Only shows/hides the cursor; clicks come from the InputDispatcher
+        self.clicks = main_exp.input.subscribe("questionnaire", ["click"])
+        self.hand_cursor = self.win.winHandle.get_system_mouse_cursor("hand")
+        self.hovered = None  # Index of the button under the mouse
 
     def ask(self, correct_answers, block_type, repeat_intro=False, ) -> bool:
         """
@@ -146,122 +262,1657 @@ class Questionnaire:
         answers = []
         for i in range(len(self.answers)):
             self.mouse.visible = True
+            self.main_exp.input.start("questionnaire")  # A click from before the question does not count
             response = None
-            while not response:
-                # Draw 4 buttons
-                for pos, button, answer in zip(self.positions, self.buttons.values(), self.answers[i]):
-                    button.pos = pos
-                    button.draw()
-                    self.button_message.text = answer
-                    self.button_message.pos = pos
-                    self.button_message.draw()
-                self.main_exp.communication(f"question{i + 1}", pos=(0, 0.4), wait_resp=False, size=0.1, block_type = block_type)
-
-                # Register mouse click
-                response = self.mouse_handler()
-
-            answers.append(self.answers[i][int(response) - 1])
+            while response is None:
+                # One frame: draw the page, wait for the flip (CPU idles until the screen refresh), then check the mouse
+                self.draw_page(i, block_type)
+                self.main_exp.frame_timer.flip("questionnaire")
+
+                # Register mouse click (dry run: the responder clicks)
+                if self.main_exp.backend.responder:
+                    response = int(self.main_exp.backend.responder.click(i, self.answers[i], correct_answers[i])) - 1
+                else:
+                    response = self.mouse_handler()
+            self.main_exp.input.stop()
+
+            answers.append(self.answers[i][response])
             if i != len(self.answers) - 1:
-                self.win.flip()
-                core.wait(1)
+                self.main_exp.frame_timer.flip("questionnaire")
+                self.main_exp.frame_timer.pause()
+                self.main_exp.backend.wait(1)
             else:
                 self.mouse.visible = False
         return check_correct(answers, correct_answers)
 
-    def mouse_handler(self) -> str:
+    def draw_page(self, question: int, block_type: str) -> None:
+        """
+        Draws the question and its 4 buttons (does not flip)
+        :param question: Index of the question
+        :param block_type: Congruent or incongruent
+        :return: None
+        """
+        for button, label in zip(self.buttons, self.labels[question]):
+            button.draw()
+            label.draw()
+        self.questions[block_type][question].draw()
+
+    def mouse_handler(self):
+        """
+        Checks the mouse once: changes the cursor when it enters or leaves a button and registers a click on a button
+        :return: Index of the clicked button, or None
+        """
+        hovered = self.button_at(self.main_exp.input.mouse_pos)
+        # Change appearance of mouse (only when entering or leaving a button) to indicate button is clickable
+        if hovered != self.hovered:
+            if hovered is None:
+                self.win.winHandle.set_mouse_cursor()
+            elif self.hovered is None:
+                self.win.winHandle.set_mouse_cursor(self.hand_cursor)
+            self.hovered = hovered
+
+        # Clicks since the previous frame (press of the left button, with the position at that moment)
+        for name, x, y, click_time in self.clicks.get():
+            clicked = self.button_at((x, y))
+            if clicked is not None:
+                self.win.winHandle.set_mouse_cursor()
+                self.hovered = None
+                return clicked
+        return None
+
+    def button_at(self, pos):
+        """
+        :param pos: Position (x, y; norm units) or None
+        :return: Index of the button at this position, or None
+        """
+        if pos is None:
+            return None
+        x, y = pos
+        return next((i for i, (left, bottom, right, top) in enumerate(self.hit_boxes)
+                     if left <= x <= right and bottom <= y <= top), None)
+
+
+class Subscription:
+    def __init__(self, dispatcher, phase: str, names):
+        """
+        Events of one phase for one reader (see InputDispatcher.subscribe)
+        :param dispatcher: InputDispatcher
+        :param phase: Phase in which the events are collected
+        :param names: Event names to collect (keys, e.g. space, or click)
+        """
+        self.dispatcher = dispatcher
+        self.phase = phase
+        self.names = set(names)
+        self.events = deque()  # Appended by the input thread, emptied by the main thread (deque needs no lock for this)
+        self.arrived = threading.Event()  # Set by the dispatcher when an event is appended
+
+    def get(self) -> list:
+        """
+        :return: list of the events since the previous call (oldest first): [name, rt, time] for keys (rt: since the
+                 start of the phase), ["click", x, y, time] for mouse clicks
+        """
+        if self.dispatcher.thread is None:
+            self.dispatcher.pump()
+        self.dispatcher.pump_main()
+        self.arrived.clear()
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return self.dispatcher.backend.delivered(events)
+
+    def wait(self, interval=0.01) -> list:
+        """
+        Waits until there are events: sleeps until the input thread passes one on (without it, reads the devices and takes
+        a sample every interval: the screen is not flipped meanwhile); wakes every 100 ms to read the main thread part of
+        the devices (mouse, window events)
+        :param interval: Seconds between reads of the devices when there is no input thread
+        :return: list of the events (see get)
+        """
+        events = self.get()
+        while not events:
+            if self.dispatcher.thread is None:
+                self.dispatcher.sample()
+                self.dispatcher.backend.idle(interval)
+            else:
+                self.arrived.wait(0.1)
+            events = self.get()
+        return events
+
+
+class InputDispatcher:
+    IDLE_RATE = 100  # Times per second the thread reads the devices without a sampler
+
+    def __init__(self, window, backend, sample_rate=1000):
+        """
+        The only reader of keyboard and mouse. Their events (timestamped) are passed to the readers (Subscription) of the
+        current phase; events in other phases are dropped, so no reader takes the key press of another. Escape aborts the
+        session in any phase: the main thread gets a KeyboardInterrupt (handled by Exp), nothing polls for it.
+        A background thread reads what is safe to read off the main thread (the psychtoolbox keyboard buffer); the mouse
+        (and a keyboard that needs the pyglet event loop) is read on the main thread, on every flip (FrameTimer) and when
+        a reader asks for its events. Without the thread (no psychtoolbox, dry run and replay, which stay deterministic)
+        all devices are read on every flip and when a reader asks for its events.
+        :param window: Window (mouse positions in its norm units)
+        :param backend: Provides the devices (input_device)
+        :param sample_rate: Times per second the thread reads the devices while a sampler is attached (see InputSampler);
+                            otherwise IDLE_RATE (key times come from the keyboard's own timestamps, so they are exact at
+                            either rate). Without the thread, a sample is taken on every flip (see samples_per_second)
+        """
+        self.backend = backend
+        self.device = backend.input_device(window)
+        self.sample_rate = sample_rate
+        self.phase = None
+        self.subscriptions = {}  # Phase -> list of Subscription
+        self.mouse_pos = None  # Latest mouse position (x, y)
+        self.pressed = 0  # Keys and mouse button held down (bits of InputSampler.INPUTS)
+        self.sampler = None  # InputSampler of the current participant
+        self.aborted = False
+        self.escape_from = 0.0  # Escape pressed before this time (clock of the device) does not abort
+        self.lock = threading.Lock()  # pressed is updated from both threads
+        self.thread = None
+        if self.device.threaded:
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+
+    def subscribe(self, phase: str, names) -> Subscription:
+        """
+        :param phase: Phase in which the events are collected
+        :param names: Event names to collect (keys, e.g. space, or click)
+        :return: Subscription (read with .get() or .wait())
+        """
+        subscription = Subscription(self, phase, names)
+        self.subscriptions.setdefault(phase, []).append(subscription)
+        return subscription
+
+    def start(self, phase: str) -> None:
+        """
+        Starts a phase (e.g. on the flip of the stimulus onset): events from before are discarded, reaction times of key
+        presses count from now
+        :param phase: Name of the phase
+        :return: None
+        """
+        for subscription in self.subscriptions.get(phase, ()):
+            subscription.events.clear()
+            subscription.arrived.clear()
+        self.device.start(phase)
+        self.phase = phase
+
+    def stop(self) -> None:
+        self.phase = None
+
+    def pump(self) -> None:
+        """
+        Reads the devices once (the part that the input thread may read) and passes their events on
+        :return: None
+        """
+        self.route(self.device.poll())
+
+    def pump_main(self) -> None:
+        # Part of the devices that may only be read on the main thread (pyglet)
+        self.route(self.device.poll_main())
+
+    def frame(self) -> None:
+        """
+        Reads the devices after a flip (FrameTimer): the main thread part, and without input thread also the rest, and
+        then takes the sample of this frame
+        :return: None
+        """
+        if self.thread is None:
+            self.pump()
+        self.pump_main()
+        if self.thread is None:
+            self.sample()
+
+    def sample(self) -> None:
+        sampler = self.sampler
+        if sampler is not None:
+            sampler.sample(self.device.time(), self.pressed, self.mouse_pos)
+
+    def samples_per_second(self, refresh_rate: float) -> int:
+        """
+        :param refresh_rate: Refresh rate of the display (Hz)
+        :return: Rate of the samples: sample_rate on the input thread, else one sample per frame
+        """
+        return self.sample_rate if self.thread is not None else math.ceil(refresh_rate)
+
+    def route(self, events: list) -> None:
+        subscriptions = self.subscriptions.get(self.phase, ())
+        for event in events:
+            name = event[0]
+            if name == "pos":
+                self.mouse_pos = (event[1], event[2])
+            elif name == "release":
+                with self.lock:
+                    self.pressed &= ~InputSampler.INPUTS.get(event[1], 0)
+            else:
+                with self.lock:
+                    self.pressed |= InputSampler.INPUTS.get(name, 0)
+                if name == "escape" and event[2] >= self.escape_from:
+                    self.abort()
+                for subscription in subscriptions:
+                    if name in subscription.names:
+                        subscription.events.append(event)
+                        subscription.arrived.set()
+
+    def worker(self) -> None:
+        # Fixed rate: sleeps until the next sample is due; when it falls behind, it continues from now (no burst)
+        next_time = time.perf_counter()
+        while True:
+            self.pump()
+            self.sample()
+            next_time += 1 / (self.IDLE_RATE if self.sampler is None else self.sample_rate)
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.perf_counter()
+
+    def abort(self) -> None:
+        if self.aborted:
+            return
+        self.aborted = True
+        if self.thread is None:
+            raise KeyboardInterrupt
+        _thread.interrupt_main()
+
+
+class InputSampler:
+    # Bit of every input in the pressed column
+    INPUTS = {"space": 1, "escape": 2, "click": 4}
+    BLOCK_TYPES = ("congruent", "incongruent")
+    PHASES = ("loading", "communication", "questionnaire", "iti", "fixation", "stimulus", "feedback")
+
+    def __init__(self, path, frame_timer, sample_rate: int, seconds=3600):
+        """
+        Input state (keys and mouse button held down, mouse position) at every sample of the InputDispatcher (on the input
+        thread, or after every flip without it; the mouse is read on the main thread, so its position changes once per
+        frame), with the trial and phase on screen (FrameTimer.segment), written into a preallocated ring buffer: a .npy file mapped in
+        memory, so a sample is one row assignment and the analysis reads the file without loading it
+        (RPEP_analysis.input_samples). The codes of block_type, phase and pressed are saved next to it (.json).
+        :param path: Path of the samples (.npy)
+        :param frame_timer: FrameTimer of the participant
+        :param sample_rate: Samples per second (InputDispatcher.samples_per_second)
+        :param seconds: Length of the ring buffer; after that the oldest samples are overwritten
+        """
+        import numpy
+        self.path = path
+        self.frame_timer = frame_timer
+        self.dtype = numpy.dtype([
+            ("sample", "<u8"),  # 1, 2, ... (0: row not written yet); order of the rows once the buffer wrapped around
+            ("time", "<f8"),  # s, psychopy clock (same as stimulus_onset and keypress_time in the datafile)
+            ("block_type", "i1"),  # Index in BLOCK_TYPES, -1 outside the trials
+            ("trial_nr", "<i2"),  # -1 outside the trials
+            ("phase", "i1"),  # Index in PHASES
+            ("pressed", "u1"),  # Bits of INPUTS
+            ("x", "<f4"),  # Mouse position (norm units), NaN before the mouse was read
+            ("y", "<f4"),
+        ])
+        self.buffer = numpy.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(sample_rate * seconds,))
+        self.n_samples = 0
+        self.segment = None
+        self.codes = (-1, -1, -1)
+        with open(path.rsplit(".", 1)[0] + ".json", "w", encoding="utf-8") as file:
+            json.dump({"sample_rate": sample_rate, "inputs": self.INPUTS, "block_types": self.BLOCK_TYPES,
+                       "phases": self.PHASES}, file, indent=1)
+
+    def sample(self, sample_time: float, pressed: int, mouse_pos) -> None:
+        """
+        Writes one sample (on the input thread, or after a flip)
+        :param sample_time: Time of the sample
+        :param pressed: Bits of the inputs held down
+        :param mouse_pos: Mouse position (x, y) or None
+        :return: None
+        """
+        segment = self.frame_timer.segment
+        if segment is not self.segment:
+            # New frame: look up the codes of its trial and phase
+            self.segment = segment
+            block_type, trial_nr, phase = segment
+            self.codes = (
+                self.BLOCK_TYPES.index(block_type) if block_type in self.BLOCK_TYPES else -1,
+                -1 if trial_nr is None else trial_nr,
+                self.PHASES.index(phase) if phase in self.PHASES else -1,
+            )
+        x, y = mouse_pos or (math.nan, math.nan)
+        self.n_samples += 1
+        self.buffer[(self.n_samples - 1) % len(self.buffer)] = (self.n_samples, sample_time, *self.codes, pressed, x, y)
+
+    def close(self) -> None:
+        self.buffer.flush()
+
+
+class ResponseCollector:
+    def __init__(self, window, backend, dispatcher, key_list=("space",)):
+        """
+        Collects the keyboard response of a trial (reader of the stimulus phase of the InputDispatcher), timed relative
+        to the flip on which the stimulus appeared
+        :param window: Window on which the stimulus is presented
+        :param backend: PsychopyBackend or DryRunBackend (provides the clock)
+        :param dispatcher: InputDispatcher
+        :param key_list: Keys that count as a response
+        """
+        self.win = window
+        self.backend = backend
+        self.input = dispatcher
+        self.responses = dispatcher.subscribe("stimulus", key_list)
+        self.onset = None
+
+    def arm(self) -> None:
+        """
+        Starts the stimulus phase on the next flip (earlier key presses are discarded, reaction times count from the
+        flip) and stamps the stimulus onset
+        :return: None
+        """
+        self.onset = None
+        self.win.callOnFlip(self.input.start, "stimulus")
+        self.win.callOnFlip(self.stamp_onset)
+
+    def stamp_onset(self) -> None:
+        # Same clock as the key timestamps (key.tDown)
+        self.onset = self.backend.get_time()
+
+    def poll(self, deadline: float):
+        """
+        Checks (without blocking) whether a key was pressed since the stimulus onset
+        :param deadline: Key presses later than this (s after onset) are ignored
+        :return: First pressed key (with .name, .rt and .tDown) or None
+        """
+        keys = [key for key in key_presses(self.responses.get()) if key.rt >= 0]  # Not pressed before the onset
+        return keys[0] if keys and keys[0].rt <= deadline else None
+
+    def disarm(self) -> None:
+        # End of the response window: later key presses are dropped
+        self.input.stop()
+
+
+class TextCache:
+    def __init__(self, window, stim_class, wrap_width, max_size=64):
+        """
+        Keeps laid-out TextStims ready to draw, so every message is only built the first time it is shown
+        :param window: Window on which the messages are drawn
+        :param stim_class: TextStim class of the backend
+        :param wrap_width: Width (norm units) at which text is wrapped
+        :param max_size: Max amount of stored messages (least recently used message is removed first)
+        """
+        self.win = window
+        self.stim_class = stim_class
+        self.wrap_width = wrap_width
+        self.max_size = max_size
+        self.stims = OrderedDict()
+
+    def get(self, key, make_text, color, size, pos):
+        """
+        Returns the TextStim of a message, creates it if not stored yet
+        :param key: Hashable description of the message (text key, formatting arguments, color, size and position)
+        :param make_text: Function that returns the text (only called if the message is not stored yet)
+        :param color: Color of the text
+        :param size: Size of the text
+        :param pos: Position of the text on the screen
+        :return: TextStim
+        """
+        if key in self.stims:
+            self.stims.move_to_end(key)
+            return self.stims[key]
+
+        stim = self.stim_class(self.win, text=make_text(), color=color, height=size, pos=pos, wrapWidth=self.wrap_width)
+        self.stims[key] = stim
+        if len(self.stims) > self.max_size:
+            self.stims.popitem(last=False)
+        return stim
+
+
+class FrameTimer:
+    def __init__(self, window, refresh_rate, long_frame=1.5, dispatcher=None):
+        """
+        Flips the window and records every frame interval with the trial and phase it belongs to, so late stimuli can be
+        found per trial
+        :param window: Window to flip
+        :param refresh_rate: Measured refresh rate (Hz)
+        :param long_frame: Frame intervals longer than this many frames count as dropped frames
+        :param dispatcher: InputDispatcher: reads the mouse after every flip (on the main thread)
+        """
+        self.win = window
+        self.dispatcher = dispatcher
+        self.refresh_rate = refresh_rate
+        self.threshold = long_frame / refresh_rate
+        # psychopy counts dropped frames too (win.nDroppedFrames), as a cross-check; its counts of the previous
+        # participant (same window in a session) are reset
+        self.win.refreshThreshold = self.threshold
+        self.win.recordFrameIntervals = True
+        if hasattr(self.win, "frameIntervals"):
+            self.win.frameIntervals = []
+            self.win.nDroppedFrames = 0
+
+        self.trial = (None, None)  # Block type and trial number
+        self.segment = (None, None, None)  # Block type, trial number and phase of the last flip (read by InputSampler)
+        self.last_flip = None
+        self.frames = []  # (block_type, trial_nr, phase, interval) of every recorded frame of the session
+        self.trial_intervals = []
+
+    def flip(self, phase: str) -> float:
+        """
+        Flips the window and records the interval since the previous flip
+        :param phase: Phase of the frame (iti, fixation, stimulus, feedback, communication, questionnaire)
+        :return: Time of the flip
+        """
+        if self.last_flip is None:
+            self.win.recordFrameIntervals = True
+        flip_time = self.win.flip()
+        self.segment = (*self.trial, phase)
+        if self.dispatcher:
+            self.dispatcher.frame()
+        if self.last_flip is not None:
+            interval = flip_time - self.last_flip
+            self.frames.append((*self.trial, phase, interval))
+            if self.trial[1] is not None:
+                self.trial_intervals.append(interval)
+        self.last_flip = flip_time
+        return flip_time
+
+    def pause(self) -> None:
+        """
+        The screen is not updated for a while (e.g. waiting for a key): the next interval is not a frame
+        :return: None
+        """
+        self.last_flip = None
+        self.win.recordFrameIntervals = False
+
+    def next_trial(self, trial_nr, block_type=None):
+        """
+        Ends the current trial and starts counting the frames of the next one
+        :param trial_nr: Number of the next trial (None: no trial)
+        :param block_type: Block of the next trial
+        :return: dictionary of timing-quality columns of the ended trial (dropped_frames, longest_frame)
+        """
+        quality = {
+            "dropped_frames": sum(interval > self.threshold for interval in self.trial_intervals),
+            "longest_frame": max(self.trial_intervals, default=None),  # s
+        }
+        self.trial = (block_type, trial_nr)
+        self.trial_intervals = []
+        return quality
+
+    def summary(self, n_worst=20) -> dict:
+        """
+        Frame timing of the whole session
+        :param n_worst: Amount of longest frames to list
+        :return: dictionary (frame interval histogram in ms, dropped frames per phase, longest frames)
+        """
+        dropped = Counter(phase for block_type, trial_nr, phase, interval in self.frames if interval > self.threshold)
+        return {
+            "refresh_rate": self.refresh_rate,
+            "long_frame_threshold": self.threshold,
+            "n_frames": len(self.frames),
+            "dropped_frames": sum(dropped.values()),
+            "dropped_frames_per_phase": dict(dropped),
+            "psychopy_dropped_frames": getattr(self.win, "nDroppedFrames", None),
+            "interval_histogram_ms": dict(sorted(Counter(round(frame[-1] * 1000) for frame in self.frames).items())),
+            "worst_frames": [
+                {"block_type": block_type, "trial_nr": trial_nr, "phase": phase, "interval": interval}
+                for block_type, trial_nr, phase, interval in heapq.nlargest(n_worst, self.frames, key=lambda frame: frame[-1])
+            ],
+        }
+
+
+class Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exception):
+        self.tracer.events.append((self.name, self.start, time.perf_counter_ns() - self.start, self.args, threading.get_ident()))
+
+
+class Tracer:
+    def __init__(self, enabled=False):
+        """
+        Records nested spans (name, start, duration) with the high-resolution clock, to see where the time of a session
+        goes; exported as Chrome trace JSON (chrome://tracing or ui.perfetto.dev)
+        :param enabled: Record spans; if False, span() returns a shared do-nothing context manager
+        """
+        self.enabled = enabled
+        self.events = []  # (name, start ns, duration ns, args, thread)
+        self.origin = time.perf_counter_ns()
+
+    def span(self, name: str, **args):
         """
-        Returns name of pressed button during the questionnaires
-        :return: Name of pressed button
+        Use as "with tracer.span(name):"
+        :param name: Name of the span
+        :param args: Extra information shown with the span (e.g. trial_nr)
+        :return: context manager
         """
-        # Check if any button is being hovered by the mouse
-        for name, button in self.buttons.items():
-            while button.contains(self.mouse):
-                # Change appearance of mouse to indicate button is clickable
-                self.win.winHandle.set_mouse_cursor(self.win.winHandle.get_system_mouse_cursor("hand"))
-                # If hovering and pressed: return name of clicked button
-                if self.mouse.getPressed()[0]:
-                    self.win.winHandle.set_mouse_cursor()
-                    return name
-                self.main_exp.escape_check()
-            # Reset mouse appearance if not hovering any button
-            self.win.winHandle.set_mouse_cursor()
-        self.main_exp.escape_check()
+        return Span(self, name, args) if self.enabled else NO_SPAN
+
+    def export(self, path) -> None:
+        """
+        Writes the recorded spans as Chrome trace JSON (complete events, times in µs)
+        :param path: Path of the trace file
+        :return: None
+        """
+        events = [
+            {"name": name, "ph": "X", "ts": (start - self.origin) / 1000, "dur": duration / 1000, "pid": os.getpid(),
+             "tid": thread, "args": args}
+            for name, start, duration, args, thread in self.events
+        ]
+        events.append({"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": "RPEP"}})
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+
+NO_SPAN = contextlib.nullcontext()
+
+
+# _____ BACKENDS _____ #
+class PsychopyBackend:
+    responder = None
+
+    def __init__(self):
+        """
+        Runs the experiment in real time: psychopy window and stimuli, psychopy clock, physical keyboard and mouse
+        """
+        self.visual = None
+        self.event = None
+        self.keyboard_module = None
+
+    def participant_info(self) -> tuple:
+        return info_GUI()
+
+    def date(self) -> str:
+        return time.strftime("%Y-%m-%d %H:%M")
+
+    def make_window(self, fullscr: bool):
+        # Imported here (after the participant dialog): these modules are slow to load and need a display
+        from psychopy import visual, event
+        from psychopy.hardware import keyboard
+        self.visual = visual
+        self.event = event
+        self.keyboard_module = keyboard
+        return self.visual.Window(units="norm", fullscr=fullscr)
+
+    def display_config(self, window) -> dict:
+        """
+        :param window: Window
+        :return: Everything that changes the timing of the display (a new configuration is calibrated again)
+        """
+        from pyglet import gl
+        screen = window.winHandle.screen
+        mode = screen.get_mode()  # None if the platform does not tell (e.g. X11 with Xinerama)
+        return {
+            "machine": platform.node(), "screen": [screen.width, screen.height], "window": [int(n) for n in window.size],
+            "fullscreen": bool(window.fullscr), "renderer": gl.gl_info.get_renderer(), "driver": gl.gl_info.get_version(),
+            # Rate of the screen mode (on X11 the dot clock): a new rate at the same resolution is a new configuration
+            "refresh_rate": mode.rate if mode else None
+        }
+
+    def timing_profile(self, window, cached):
+        # Measured on this machine (Exp.calibrate) if not cached
+        return cached
+
+    def input_device(self, window):
+        return PsychopyInput(self.keyboard_module.Keyboard(), self.event.Mouse(win=window, visible=False))
+
+    def mouse(self, window):
+        return self.event.Mouse(win=window, visible=False)
+
+    def get_time(self) -> float:
+        return core.getTime()
+
+    def wait(self, duration: float) -> None:
+        core.wait(duration)
+
+    def idle(self, duration: float) -> None:
+        # Waits without busy waiting (core.wait does in its last 0.2 s): for input, not for timing
+        core.wait(duration, hogCPUperiod=0)
+
+    def wait_event(self, event, timeout: float) -> bool:
+        # Waits for a threading.Event of a background thread (e.g. the asset loader)
+        return event.wait(timeout)
+
+    def delivered(self, events: list) -> list:
+        # Events that reach the experiment (recorded by RecordingBackend)
+        return events
+
+    def aborted(self) -> None:
+        pass
+
+    def quit(self) -> None:
+        core.quit()
+
+
+class PsychopyInput:
+    def __init__(self, keyboard, mouse, key_list=("space", "escape")):
+        """
+        Keyboard (psychopy's hardware keyboard) and mouse of the real experiment. pyglet is not thread safe: only the
+        psychtoolbox keyboard buffer is read by the thread of the InputDispatcher (poll); the mouse, and the keyboard
+        without psychtoolbox (falls back to the pyglet event loop), are read on the main thread (poll_main)
+        :param keyboard: psychopy.hardware.keyboard.Keyboard
+        :param mouse: psychopy.event.Mouse
+        :param key_list: Keys that are read (others are ignored)
+        """
+        self.keyboard = keyboard
+        self.mouse = mouse
+        self.threaded = keyboard.getBackend() == "ptb"
+        self.key_list = list(key_list)
+        self.down = []  # Key presses not released yet (psychopy sets their duration on release)
+        self.pos = None
+        self.pressed = False
+
+    def start(self, phase: str) -> None:
+        # Key presses from before the phase do not count: without psychtoolbox they are cleared (their rt would only
+        # count from when they are read), with psychtoolbox they get a negative rt and poll_keyboard drops them (the
+        # input thread reads the same buffer)
+        self.keyboard.clock.reset()
+        if not self.threaded:
+            self.keyboard.clearEvents()
+
+    def poll(self) -> list:
+        # Input thread (psychtoolbox only)
+        return self.poll_keyboard() if self.threaded else []
+
+    def poll_main(self) -> list:
+        """
+        :return: list of new events: [key, rt, tDown] (without psychtoolbox), ["pos", x, y] (mouse moved),
+                 ["click", x, y, time] (left button went down) and ["release", key or click, time]
+        """
+        events = [] if self.threaded else self.poll_keyboard()
+        x, y = (float(coordinate) for coordinate in self.mouse.getPos())
+        if (x, y) != self.pos:
+            self.pos = (x, y)
+            events.append(["pos", x, y])
+        pressed = bool(self.mouse.getPressed()[0])
+        if pressed != self.pressed:
+            events.append(["click", x, y, core.getTime()] if pressed else ["release", "click", core.getTime()])
+        self.pressed = pressed
+        return events
+
+    def poll_keyboard(self) -> list:
+        """
+        :return: list of new key events: [key, rt, tDown] and ["release", key, time]
+        """
+        pressed_keys = self.keyboard.getKeys(keyList=self.key_list, waitRelease=False)
+        # Keys pressed and already released since the previous poll are only returned with waitRelease
+        tapped_keys = self.keyboard.getKeys(keyList=self.key_list, waitRelease=True)
+        events = [
+            [key.name, number(key.rt), number(key.tDown)] for key in pressed_keys + tapped_keys
+            if key.rt >= 0 or key.name == "escape"  # Pressed before the start of the phase (escape aborts anyway)
+        ]
+        self.down += pressed_keys
+        for key in self.down + tapped_keys:
+            if key.duration is not None:
+                events.append(["release", key.name, number(key.tDown + key.duration)])
+        self.down = [key for key in self.down if key.duration is None]
+        return events
+
+    def time(self) -> float:
+        return core.getTime()
+
+
+class HeadlessStim:
+    def __init__(self, *args, **kwargs):
+        """
+        Stands in for every psychopy stimulus (and mouse/window handle) in a dry run: stores attributes, draws nothing
+        """
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        # Any method (draw, contains, set_mouse_cursor, ...) does nothing
+        return lambda *args, **kwargs: None
+
+
+class HeadlessWindow:
+    def __init__(self, backend, size=(1920, 1080)):
+        """
+        Stands in for the psychopy window in a dry run: every flip advances the virtual clock by one frame
+        :param backend: DryRunBackend that owns the virtual clock
+        :param size: Simulated screen size (pixels)
+        """
+        self.backend = backend
+        self.size = size
+        self.winHandle = HeadlessStim()
+        self.flip_callbacks = []
+
+    def callOnFlip(self, function, *args, **kwargs) -> None:
+        self.flip_callbacks.append((function, args, kwargs))
+
+    def flip(self, clearBuffer=True) -> float:
+        self.backend.now += 1 / self.backend.refresh_rate
+        for function, args, kwargs in self.flip_callbacks:
+            function(*args, **kwargs)
+        self.flip_callbacks = []
+        return self.backend.now
+
+    def getActualFrameRate(self, *args, **kwargs) -> float:
+        return self.backend.refresh_rate
+
+    def clearBuffer(self, *args, **kwargs) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class HeadlessInput:
+    KEY_HOLD = 0.1  # Time (s) between press and release of a key
+    threaded = False
+
+    def __init__(self, backend):
+        """
+        Stands in for keyboard and mouse in a dry run: presses space at the time chosen by the responder during the
+        stimulus, and right away when a message waits for a key
+        :param backend: DryRunBackend (virtual clock and responder)
+        """
+        self.backend = backend
+        self.start_time = 0.0
+        self.response_time = None
+        self.release_time = None
+        self.pending = []
+
+    def start(self, phase: str) -> None:
+        self.start_time = self.backend.now
+        self.response_time = None
+        if phase == "stimulus":
+            # Stimulus onset: ask the responder whether (and when) this trial gets a response
+            self.response_time = self.backend.responder.trial_response()
+        elif phase in ("communication", "calibration"):
+            self.pending = [["space", 0.0, self.backend.now]]
+            self.release_time = self.backend.now + self.KEY_HOLD
+
+    def poll(self) -> list:
+        events, self.pending = self.pending, []
+        if self.response_time is not None and self.backend.now >= self.start_time + self.response_time:
+            events.append(["space", self.response_time, self.start_time + self.response_time])
+            self.release_time = self.start_time + self.response_time + self.KEY_HOLD
+            self.response_time = None
+        if self.release_time is not None and self.backend.now >= self.release_time:
+            events.append(["release", "space", self.release_time])
+            self.release_time = None
+        return events
+
+    def poll_main(self) -> list:
+        return []
+
+    def time(self) -> float:
+        return self.backend.now
+
+
+class HeadlessVisual:
+    def __getattr__(self, name):
+        # visual.Circle, visual.TextStim, ... all become HeadlessStim
+        return HeadlessStim
+
+
+class DryRunBackend:
+    def __init__(self, participant_info=("1", "X/andere", "20", "Nee"), responder=None, refresh_rate=60.0):
+        """
+        Runs the experiment without display on a virtual clock: waiting and flipping only advance virtual time, responses
+        come from a responder, so a full session finishes in seconds (e.g. to test changes to Exp.main)
+        :param participant_info: Participant number, gender, age and colorblindness (replaces info_GUI)
+        :param responder: Gives trial responses and questionnaire clicks (default: RandomResponder)
+        :param refresh_rate: Simulated refresh rate (Hz)
+        """
+        self.info = participant_info
+        self.responder = responder or RandomResponder()
+        self.refresh_rate = refresh_rate
+        self.now = 0.0
+        self.visual = HeadlessVisual()
+
+    def participant_info(self) -> tuple:
+        return self.info
+
+    def date(self) -> str:
+        return time.strftime("%Y-%m-%d %H:%M")
+
+    def make_window(self, fullscr: bool):
+        return HeadlessWindow(self)
+
+    def display_config(self, window) -> dict:
+        return {"machine": "dry_run", "window": [int(n) for n in window.size], "refresh_rate": self.refresh_rate}
+
+    def timing_profile(self, window, cached) -> dict:
+        # Nothing to measure on the virtual clock: exact frames, draws and keys take no time
+        return {
+            "refresh_rate": self.refresh_rate, "flip_interval_mean": 1 / self.refresh_rate, "flip_interval_sd": 0.0,
+            "flip_interval_max": 1 / self.refresh_rate, "text_draw": 0.0, "shape_draw": 0.0, "key_latency_mean": 0.0,
+            "key_latency_max": 0.0, "window_size": [int(n) for n in window.size]
+        }
+
+    def input_device(self, window):
+        return HeadlessInput(self)
+
+    def mouse(self, window):
+        return HeadlessStim()
+
+    def get_time(self) -> float:
+        return self.now
+
+    def wait(self, duration: float) -> None:
+        self.now += max(duration, 0)
+
+    def idle(self, duration: float) -> None:
+        self.wait(duration)
+
+    def wait_event(self, event, timeout: float) -> bool:
+        return event.wait(timeout)
+
+    def delivered(self, events: list) -> list:
+        return events
+
+    def aborted(self) -> None:
+        pass
+
+    def quit(self) -> None:
+        sys.exit()
+
+
+class RandomResponder:
+    def __init__(self, p_go=0.5, response_times=(0.25, 0.75), seed=None):
+        """
+        Responds randomly to every trial and answers the questionnaire correctly
+        :param p_go: Probability of pressing space in a trial
+        :param response_times: Min and max response time (s, uniform)
+        :param seed: Seed of the random generator
+        """
+        self.p_go = p_go
+        self.response_times = response_times
+        self.random = random.Random(seed)
+
+    def trial_response(self):
+        """
+        :return: Response time (s) or None (no response)
+        """
+        if self.random.random() < self.p_go:
+            return self.random.uniform(*self.response_times)
+        return None
+
+    def click(self, question: int, options: list, correct_answer: str) -> str:
+        """
+        :return: Name of the clicked button (correct option)
+        """
+        return next(str(i + 1) for i, option in enumerate(options) if check_answer(question, option, correct_answer))
+
+
+class ScriptedResponder(RandomResponder):
+    def __init__(self, response_times):
+        """
+        Gives a fixed sequence of trial responses and answers the questionnaire correctly
+        :param response_times: Response time (s) or None (no response) for each trial, in order
+        """
+        super().__init__()
+        self.response_times = iter(response_times)
+
+    def trial_response(self):
+        return next(self.response_times, None)
+
+
+def key_presses(keys) -> list:
+    """
+    :param keys: Recorded keys: list of [name, rt, tDown]
+    :return: list of key presses (with .name, .rt and .tDown, like psychopy's hardware keyboard)
+    """
+    return [SimpleNamespace(name=name, rt=rt, tDown=t_down) for name, rt, t_down in keys]
+
+
+def number(value):
+    # psychopy may return numpy floats: recorded (and returned) as python floats, so a replay computes exactly the same
+    return None if value is None else float(value)
+
+
+class RecordingBackend:
+    def __init__(self, backend, settings=None):
+        """
+        Wraps a backend and records, in order, everything that comes from outside the program: participant info, date,
+        refresh rate, flip times, clock reads, input events as delivered by the InputDispatcher (keys and clicks with
+        their timestamps), escape and questionnaire clicks of a dry run. ReplayBackend
+        feeds these back, so the same session (same seeds in settings) gives the same datafile again.
+        :param backend: PsychopyBackend or DryRunBackend
+        :param settings: Seeds and settings of Exp needed to rebuild the session (saved with the recording)
+        """
+        self.backend = backend
+        self.settings = dict(settings or {})
+        self.events = []
+        self.startup = []
+        self.path = None  # Set by Exp (next to the datafile)
+        self.n_saved = None
+        self.responder = backend.responder and SimpleNamespace(
+            click=lambda *args: self.record("click", backend.responder.click(*args))
+        )
+        atexit.register(self.save)  # An aborted session is saved too (replays up to the escape)
+
+    def __getattr__(self, name):
+        # visual, refresh_rate, ... of the wrapped backend
+        return getattr(self.backend, name)
+
+    def record(self, kind: str, value):
+        self.events.append((kind, value))
+        return value
+
+    def participant_info(self) -> tuple:
+        return tuple(self.record("participant_info", list(self.backend.participant_info())))
+
+    def date(self) -> str:
+        return self.record("date", self.backend.date())
+
+    def make_window(self, fullscr: bool):
+        window = self.backend.make_window(fullscr)
+        self.settings["window_size"] = [int(size) for size in window.size]
+        # Only flip and getActualFrameRate are recorded: the window itself is passed on to the stimuli unchanged
+        flip, frame_rate = window.flip, window.getActualFrameRate
+        window.flip = lambda clearBuffer=True: self.record("flip", number(flip(clearBuffer)))
+        window.getActualFrameRate = lambda *args, **kwargs: self.record("frame_rate", number(frame_rate(*args, **kwargs)))
+        return window
+
+    def get_time(self) -> float:
+        return self.record("time", number(self.backend.get_time()))
+
+    def wait(self, duration: float) -> None:
+        self.backend.wait(duration)
+
+    def idle(self, duration: float) -> None:
+        self.backend.idle(duration)
+
+    def wait_event(self, event, timeout: float) -> bool:
+        return self.record("event", self.backend.wait_event(event, timeout))
+
+    def display_config(self, window) -> dict:
+        return self.record("display_config", self.backend.display_config(window))
+
+    def timing_profile(self, window, cached):
+        # The cached profile (or None: measured, and the measurement is recorded)
+        return self.record("timing_profile", self.backend.timing_profile(window, cached))
+
+    def delivered(self, events: list) -> list:
+        # Only what reaches the main thread is recorded (not when the input thread read it)
+        return self.record("input", self.backend.delivered(events))
+
+    def aborted(self) -> None:
+        self.record("abort", None)
+
+    def quit(self) -> None:
+        self.save()
+        self.backend.quit()
+
+    def mark_startup(self) -> None:
+        """
+        Keeps the events of the startup of Exp (window, loading; after the participant info) for next_participant
+        :return: None
+        """
+        self.startup = self.events[1:]
+
+    def next_participant(self) -> tuple:
+        """
+        Session of several participants: saves the recording of the previous participant and starts a new one. It begins
+        with the startup of the session after the participant info, so it replays like a separate run of RPEP.py
+        :return: Participant info of the next participant
+        """
+        self.save()
+        self.events = []
+        self.n_saved = None
+        info = self.participant_info()
+        self.events += self.startup
+        return info
+
+    def save(self) -> None:
+        """
+        Writes settings and events to self.path (gzipped JSON; only if something was added since the last save)
+        :return: None
+        """
+        if not self.path or self.n_saved == len(self.events):
+            return
+        with gzip.open(self.path, "wt", encoding="utf-8") as file:
+            json.dump({"settings": self.settings, "events": self.events}, file)
+        self.n_saved = len(self.events)
+
+
+class ReplayBackend:
+    def __init__(self, path):
+        """
+        Feeds a recorded session (RecordingBackend) back without display and without waiting: flips, clock reads and
+        input return the recorded values in the recorded order, so Exp (rebuilt with the recorded settings, see
+        RPEP_replay.py) writes the same datafile as during the recording, in a fraction of the time
+        :param path: Recording (.json.gz)
+        """
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            recording = json.load(file)
+        self.settings = recording["settings"]
+        self.events = recording["events"]
+        self.position = 0  # Index of the next event
+        self.responder = SimpleNamespace(click=lambda *args: self.next("click")) if self.settings["dry_run"] else None
+        self.visual = HeadlessVisual()
+
+    def next(self, kind: str):
+        """
+        :param kind: Kind of event the session asks for
+        :return: Recorded value of the next event
+        """
+        recorded_kind, value = self.events[self.position] if self.position < len(self.events) else (None, None)
+        if recorded_kind == "abort" and kind != "abort":
+            raise KeyboardInterrupt  # Escape was pressed here during the recording (the abort event is read by aborted)
+        self.position += 1
+        if recorded_kind != kind:
+            raise RuntimeError(f"Replay differs from the recording: session asks for {kind}, recording has {recorded_kind}")
+        return value
+
+    def participant_info(self) -> tuple:
+        return tuple(self.next("participant_info"))
+
+    def date(self) -> str:
+        return self.next("date")
+
+    def make_window(self, fullscr: bool):
+        return ReplayWindow(self, size=tuple(self.settings["window_size"]))
+
+    def display_config(self, window) -> dict:
+        return self.next("display_config")
+
+    def timing_profile(self, window, cached):
+        # As during the recording: the cached profile, or None and the calibration replays
+        return self.next("timing_profile")
+
+    def input_device(self, window):
+        # Nothing is read: the recorded events come in through delivered
+        return SimpleNamespace(threaded=False, start=lambda phase: None, poll=lambda: [], poll_main=lambda: [])
+
+    def mouse(self, window):
+        return HeadlessStim()
+
+    def get_time(self) -> float:
+        return self.next("time")
+
+    def wait(self, duration: float) -> None:
+        pass
+
+    def idle(self, duration: float) -> None:
+        pass
+
+    def wait_event(self, event, timeout: float) -> bool:
+        ready = self.next("event")
+        if ready:
+            event.wait()  # Was ready during the recording: the result is needed now
+        return ready
+
+    def delivered(self, events: list) -> list:
+        return self.next("input")
+
+    def aborted(self) -> None:
+        self.next("abort")
+
+    def quit(self) -> None:
+        sys.exit()
+
+
+class ReplayWindow(HeadlessWindow):
+    def flip(self, clearBuffer=True) -> float:
+        # As during the recording: the functions of callOnFlip run before flip returns
+        for function, args, kwargs in self.flip_callbacks:
+            function(*args, **kwargs)
+        self.flip_callbacks = []
+        return self.backend.next("flip")
+
+    def getActualFrameRate(self, *args, **kwargs) -> float:
+        return self.backend.next("frame_rate")
+
+
+# _____ ASSETS _____ #
+class AssetLoader:
+    def __init__(self, directory, cache_directory=None):
+        """
+        Decodes the images and computes the shape vertices and garnish positions on a background thread (starts right
+        away, e.g. while the participant fills in the info dialog); the textures are uploaded on the main thread later
+        :param directory: Directory with the images (bowl.png, optional)
+        :param cache_directory: Where results are cached per window resolution (None: no disk cache)
+        """
+        self.image_path = os.path.join(directory, "bowl.png")
+        self.cache_directory = cache_directory
+        self.assets = {}
+        self.progress = 0.0  # Fraction of the work done (read by the loading screen)
+        self.error = None
+        self.display = None  # Window size and bowl size (pix), known once the window is open
+        self.display_known = threading.Event()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def prepare(self, window_size, bowl_size, garnish_scale) -> None:
+        """
+        Starts the resolution dependent part of the work
+        :param window_size: Size of the window (pix)
+        :param bowl_size: Size of the bowl (pix)
+        :param garnish_scale: Scale of GARNISH_POS (window height / GARNISH_HEIGHT)
+        :return: None
+        """
+        self.display = (tuple(int(n) for n in window_size), bowl_size, garnish_scale)
+        self.display_known.set()
+
+    def result(self) -> dict:
+        """
+        Waits until everything is loaded
+        :return: dictionary of name -> numpy array (star_vertices, garnish_pos and, if bowl.png exists, bowl)
+        """
+        self.ready.wait()
+        if self.error:
+            raise self.error
+        return self.assets
+
+    def worker(self) -> None:
+        try:
+            self.load()
+        except Exception as error:  # Raised on the main thread by result()
+            self.error = error
+        self.ready.set()
+
+    def load(self) -> None:
+        import numpy
+        image = None
+        if os.path.exists(self.image_path):
+            from PIL import Image
+            image = Image.open(self.image_path)
+            image.load()
+        self.progress = 0.5
+
+        self.display_known.wait()
+        (width, height), bowl_size, garnish_scale = self.display
+        image_version = int(os.path.getmtime(self.image_path)) if image else 0
+        cache_path = self.cache_directory and os.path.join(
+            self.cache_directory, f"assets_{width}x{height}_{round(bowl_size)}_{garnish_scale:.4f}_{image_version}.npz"
+        )
+        if cache_path and os.path.exists(cache_path):
+            with numpy.load(cache_path) as cached:
+                self.assets = {name: cached[name] for name in cached.files}
+        else:
+            self.assets = {
+                "star_vertices": numpy.array(star_shape_maker(n_points=5, size=bowl_size / 7, inner_circle=2)),
+                "garnish_pos": numpy.array(GARNISH_POS) * garnish_scale,
+            }
+            if image:
+                size = round(bowl_size)
+                self.assets["bowl"] = numpy.asarray(image.convert("RGBA").resize((size, size), Image.LANCZOS))
+            if cache_path:
+                # Write and rename: an interrupted save leaves no broken cache file
+                os.makedirs(self.cache_directory, exist_ok=True)
+                numpy.savez(cache_path + ".tmp.npz", **self.assets)
+                os.replace(cache_path + ".tmp.npz", cache_path)
+        self.progress = 1.0
+
+
+# _____ DATA _____ #
+def read_session(path) -> tuple:
+    """
+    Reads a (possibly incomplete) datafile written by DataWriter; a last line cut off by a crash is ignored. A resumed
+    session continues at the first trial that was not written yet: the rows of all attempts together are the session
+    :param path: Path of the .csv or .jsonl datafile
+    :return: header (dictionary of session information; of the last attempt), list of rows (dictionaries), True if the
+             session was completed
+    """
+    with open(path, "r", newline="", encoding="utf-8") as file:
+        lines = file.read().split("\n")[:-1]  # Last element: empty or unfinished line
+
+    header, rows, complete = {}, [], False
+    if path.endswith(".jsonl"):
+        for line in lines:
+            entry = json.loads(line)
+            if "header" in entry:
+                header = entry["header"]
+            elif "complete" in entry:
+                complete = True
+            elif "row" in entry:
+                rows.append(entry["row"])
+    else:
+        columns = None
+        for line in csv.reader(lines):
+            if line and line[0].startswith("# "):
+                comment = line[0][2:]
+                if comment == "complete":
+                    complete = True
+                elif ": " in comment:
+                    key, value = comment.split(": ", 1)
+                    header[key] = value
+            elif columns is None:
+                columns = line
+            elif line != columns:  # Column line repeated by a resume (before this was fixed)
+                rows.append(dict(zip(columns, line)))
+    return header, rows, complete
+
+
+class DataWriter:
+    def __init__(self, file_name, header: dict, file_format="csv", columnar=False):
+        """
+        Appends every trial to the datafile as soon as it is finished. Writing and fsync happen on a background thread,
+        outside of the timed trial loop; after a crash only the running trial is lost. An incomplete datafile of the same
+        participant is repaired and continued (resumed: Exp continues at the first trial that is not in rows), a
+        completed one is never overwritten.
+        :param file_name: Path of the datafile without extension
+        :param header: Static session information (participant info), written at the top of the file (and again after
+                       "resumed")
+        :param file_format: "csv" (header as "# key: value" lines) or "jsonl"
+        :param columnar: Also saves the completed session as .parquet (requires pyarrow)
+        """
+        self.file_format = file_format
+        self.columnar = columnar
+        self.columns = None
+        self.rows = []  # Rows already in the datafile (resumed session)
+        self.closed = False
+
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        self.path = f"{file_name}.{file_format}"
+        copy = 0
+        while os.path.exists(self.path) and read_session(self.path)[2]:
+            copy += 1
+            self.path = f"{file_name}_{copy}.{file_format}"
+
+        self.queue = queue.Queue()
+        if os.path.exists(self.path):
+            # Resume: cut off an unfinished last line and keep appending with the columns of the file
+            with open(self.path, "rb") as file:
+                content = file.read()
+            os.truncate(self.path, content.rfind(b"\n") + 1)
+            self.rows = read_session(self.path)[1]
+            self.columns = list(self.rows[0].keys()) if self.rows else None
+            self.queue.put(("comment", "resumed"))
+        self.queue.put(("header", header))
+
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)  # Flush what is written on escape/crash (not marked as complete)
+
+    def write(self, row: dict) -> None:
+        """
+        Queues one row (does not wait for the disk)
+        :param row: dictionary of column name -> value
+        :return: None
+        """
+        self.queue.put(("row", row))
+
+    def close(self, complete=False) -> None:
+        """
+        Writes the remaining rows and stops the background thread
+        :param complete: Marks the session as completed (and saves the columnar copy)
+        :return: None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        if complete:
+            self.queue.put(("comment", "complete"))
+        self.queue.put(None)
+        self.thread.join()
+        if complete and self.columnar:
+            self.save_columnar()
+
+    def worker(self) -> None:
+        with open(self.path, "a", newline="", encoding="utf-8") as file:
+            while True:
+                # Write everything that is queued at once, then fsync
+                entries = [self.queue.get()]
+                while True:
+                    try:
+                        entries.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                file.write("".join(self.format_entry(entry) for entry in entries if entry))
+                file.flush()
+                os.fsync(file.fileno())
+                if None in entries:
+                    return
+
+    def format_entry(self, entry) -> str:
+        kind, content = entry
+        if self.file_format == "jsonl":
+            key = {"header": "header", "row": "row", "comment": content}[kind]
+            return json.dumps({key: content if kind != "comment" else True}) + "\n"
+
+        if kind == "header":
+            return "".join(f"# {key}: {value}\n" for key, value in content.items())
+        if kind == "comment":
+            return f"# {content}\n"
+        text = ""
+        if self.columns is None:
+            self.columns = list(content.keys())
+            text += self.csv_line(self.columns)
+        return text + self.csv_line([content.get(column) for column in self.columns])
+
+    @staticmethod
+    def csv_line(values) -> str:
+        line = io.StringIO()
+        csv.writer(line, lineterminator="\n").writerow(values)
+        return line.getvalue()
+
+    def save_columnar(self) -> None:
+        import pandas
+        header, rows, complete = read_session(self.path)
+        if self.file_format == "csv" and rows:
+            # pandas parses the rows into typed columns
+            table = pandas.read_csv(io.StringIO(self.csv_line(rows[0].keys()) + "".join(self.csv_line(row.values()) for row in rows)))
+        else:
+            table = pandas.DataFrame(rows)
+        table.assign(**header).to_parquet(self.path.rsplit(".", 1)[0] + ".parquet", index=False)
+
+
+class OnlineStats:
+    def __init__(self, output=None):
+        """
+        Running statistics of a session, updated in O(1) per trial by outcome_handler: accuracy per block_type x incentive x
+        correct_response cell, Go bias (P(Go | reward) - P(Go | punishment)) per block type and mean/variance of the
+        response times (Welford) per block type x incentive. Snapshots are written on a background thread.
+        :param output: Path of a JSON lines file, or an open text file (readable text, see format_stats); None: no output
+        """
+        self.cells = {}  # (block_type, incentive, correct_response) -> [trials, correct, Go responses]
+        self.response_times = {}  # (block_type, incentive) -> [n, mean, sum of squared deviations from the mean]
+        self.n_trials = 0
+        self.queue = None
+        if output is not None:
+            self.queue = queue.SimpleQueue()
+            self.thread = threading.Thread(target=self.worker, args=(output,), daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def update(self, trial, response, response_time, accuracy, feedback_points) -> None:
+        """
+        Adds one trial (arguments and results of outcome_handler)
+        :return: None
+        """
+        key = (trial["block_type"], trial["incentive"], trial["correct_response"])
+        cell = self.cells.get(key)
+        if cell is None:
+            cell = self.cells[key] = [0, 0, 0]
+        cell[0] += 1
+        cell[1] += bool(accuracy)
+        cell[2] += bool(response)
+        if response_time is not None:
+            welford = self.response_times.setdefault(key[:2], [0, 0.0, 0.0])
+            welford[0] += 1
+            delta = response_time - welford[1]
+            welford[1] += delta / welford[0]
+            welford[2] += delta * (response_time - welford[1])
+        self.n_trials += 1
+
+        if self.queue is not None:
+            last = {"color": trial["color"], "shape_name": trial["shape_name"], "correct_response": trial["correct_response"],
+                    "given_response": "Go" if response else "NoGo", "accuracy": int(accuracy), "feedback": feedback_points,
+                    "response_time": response_time}
+            self.queue.put({"type": "trial", **self.snapshot(), "last": last})
+
+    def block(self, trials) -> None:
+        """
+        Sends the created trials of a block (TrialTable) to the output
+        :return: None
+        """
+        if self.queue is not None:
+            # Column lists of the whole table at once, instead of a lookup per trial and column
+            columns = trials.columns()
+            crosstab = Counter(f"{incentive}/{response}" for incentive, response in zip(columns["incentive"], columns["correct_response"]))
+            self.queue.put({"type": "block", "block_type": trials.block_type, "crosstab": dict(crosstab),
+                            "trials": [dict(zip(columns, values)) for values in zip(*columns.values())]})
+
+    def go_bias(self, block_type: str):
+        """
+        :return: P(Go | reward) - P(Go | punishment) in the trials of this block type so far (None if not both seen)
+        """
+        n = {"reward": 0, "punishment": 0}
+        go = {"reward": 0, "punishment": 0}
+        for (cell_block_type, incentive, _), (trials, correct, go_responses) in self.cells.items():
+            if cell_block_type == block_type:
+                n[incentive] += trials
+                go[incentive] += go_responses
+        if not (n["reward"] and n["punishment"]):
+            return None
+        return go["reward"] / n["reward"] - go["punishment"] / n["punishment"]
+
+    def snapshot(self) -> dict:
+        """
+        :return: dictionary with n_trials, accuracy per cell, go_bias per block type and response_time (n, mean, sd) per
+                 block type x incentive (cells as "block_type/incentive/correct_response")
+        """
+        return {
+            "n_trials": self.n_trials,
+            "accuracy": {"/".join(key): correct / trials for key, (trials, correct, _) in self.cells.items()},
+            "go_bias": {block_type: self.go_bias(block_type) for block_type in {key[0] for key in self.cells}},
+            "response_time": {
+                "/".join(key): {"n": n, "mean": mean, "sd": (squares / (n - 1)) ** 0.5 if n > 1 else None}
+                for key, (n, mean, squares) in self.response_times.items()
+            },
+        }
+
+    def close(self) -> None:
+        """
+        Writes the remaining snapshots and stops the background thread
+        :return: None
+        """
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+            atexit.unregister(self.close)
+
+    def worker(self, output) -> None:
+        file = open(output, "a", encoding="utf-8") if isinstance(output, str) else output
+        for entry in iter(self.queue.get, None):
+            file.write(json.dumps(entry, ensure_ascii=False) + "\n" if file is not output else format_stats(entry) + "\n")
+            file.flush()
+        if file is not output:
+            file.close()
 
 
 # _____ EXPERIMENT _____ #
 class Exp:
-    def __init__(self, bowl_size, save_directory, devstats):
+    def __init__(self, bowl_size, save_directory, devstats, backend=None, data_format="csv", columnar=False, asset_cache=None,
+                 trace=False, schedule_seed=0, schedule_library=None, record=False, input_samples=False, timing_profile=None,
+                 recalibrate=False):
         """
         Runs experiment and collects data
         :param bowl_size: Size of stimuli in proportion to screen height
-        :param save_directory: Where to store acquired datafile
+        :param save_directory: Where to store acquired datafile (None: nothing is saved)
         :param devstats: Displays more information to developer if True; requires to be False for data collection
+        :param backend: PsychopyBackend (default, real time) or DryRunBackend (virtual time, no display)
+        :param data_format: Format of the datafile: "csv" or "jsonl"
+        :param columnar: Also save the completed session as .parquet (requires pyarrow)
+        :param asset_cache: Directory where the loaded images and shapes are cached per resolution (None: no disk cache)
+        :param trace: Records where the time goes (Tracer); saved next to the datafile as Chrome trace JSON
+        :param schedule_seed: Seed of the trial schedules (with the participant number; None: random seed)
+        :param schedule_library: Pregenerated schedules (.npz of RPEP_schedule.py); missing schedules are generated
+        :param record: Records seeds and input (RecordingBackend), saved next to the datafile for RPEP_replay.py
+        :param input_samples: Samples keys and mouse throughout the session (InputSampler), saved next to the datafile
+        :param timing_profile: Where the timing profiles of this machine are cached (json; None: calibrated at every start)
+        :param recalibrate: Calibrates again, even if this display configuration is cached
         """
+        self.tracer = Tracer(enabled=trace)
+        # Images and shapes are loaded in the background from the start
+        self.assets = AssetLoader(os.getcwd(), cache_directory=asset_cache)
+
         # Settings
         self.devstats = devstats
-        self.part_nr, self.gender, self.age, self.color_blind = info_GUI()
+        self.backend = backend or PsychopyBackend()
+        if schedule_seed is None:
+            schedule_seed = random.randrange(2 ** 32)  # Different every run, but known (recorded)
+        self.record = record
+        if record:
+            self.backend = RecordingBackend(self.backend, settings={
+                "bowl_size": bowl_size, "devstats": devstats, "data_format": data_format, "schedule_seed": schedule_seed,
+                "dry_run": bool(self.backend.responder)
+            })
+        self.part_nr, self.gender, self.age, self.color_blind = self.backend.participant_info()
         # If even participant number: congruent block first
         self.blocks = ["congruent", "incongruent"] if not int(self.part_nr) % 2 else ["incongruent", "congruent"]
 
         # Hardware and timer
-        self.win = visual.Window(units="norm", fullscr=not self.devstats) # Fullscreen for real experiment, in-window when testing
+        self.win = self.backend.make_window(fullscr=not self.devstats) # Fullscreen for real experiment, in-window when testing
+        self.visual = visual = self.backend.visual
         self.win.winHandle.set_mouse_cursor()
-        self.timer = core.Clock()
-
-        # Formating
-        self.win_height = self.win.size[1]
-        self.bowl_size = self.win_height * bowl_size
-        # ___ Stimuli ___
-        if os.path.exists(os.getcwd() + "/bowl.png"):
-            self.bowl = visual.ImageStim(self.win, image=os.getcwd() + "/bowl.png", size=self.bowl_size, units="pix")
-        else:
-            self.bowl = visual.Circle(self.win, color="white", size=self.bowl_size, units="pix")
-        self.bowl_go_visualisation = visual.Circle(self.win, color="black", size=self.bowl_size + 20, units="pix")
-        self.soup = visual.Circle(self.win, fillColor="black", size=self.bowl_size * 0.8, units="pix")
-
-        # Shapes
-        self.all_colors = ["purple", "blue", "yellow", "pink"]
-        random.shuffle(self.all_colors)
-
-        self.shapes = {
-            "sterren": visual.ShapeStim(
-                    self.win, vertices=star_shape_maker(n_points=5, size=self.bowl_size/7, inner_circle=2),
-                    fillColor="black", lineColor="black", units="pix"
-                ),
-            "driehoeken":
-                visual.Polygon(
-                    self.win, edges=3, size=self.bowl_size/7,
-                    color="black", units="pix",
-                ),
-            "cirkels":
-                visual.Circle(
-                    self.win, size=self.bowl_size/7,
-                    color="black", units="pix",
-                ),
-            "vierkanten":
-                visual.Rect(
-                    self.win, size=math.sqrt((self.bowl_size ** 2) / 2)/7,
-                    color="black", units="pix",
-                ),
-        }
-
-        self.shape_names = [item for item in self.shapes.keys()]  # Easier randomization
-        random.shuffle(self.shape_names)
-
-        self.garnish_pos = [(0, 0), (-90, 10), (-40, 120), (100, -100), (20, -80), (-100, -100), (60, 80)]
-        if self.win_height != 1080:
-            self.garnish_pos = [(x / 1080 * self.win_height, y / 1080 * self.win_height) for x, y in self.garnish_pos]
-        self.garnish_ori = [0, 40, 60, 10, 75, 50, 5]
+        self.input = InputDispatcher(self.win, self.backend)
+        self.response_collector = ResponseCollector(self.win, self.backend, self.input)
+        self.continue_keys = self.input.subscribe("communication", ["space"])
+        self.calibration_keys = self.input.subscribe("calibration", ["space"])
+        # Escape (or ctrl+c) during the calibration or loading quits too
+        try:
+            # Timing of this machine and display: all durations are presented as a number of frames at the measured refresh
+            # rate; a frame is dropped if it takes longer than 1.5 frames or than the normal flip jitter
+            self.timing = self.load_timing_profile(timing_profile, recalibrate)
+            self.refresh_rate = self.timing["refresh_rate"]
+            self.long_frame = max(1.5, (self.timing["flip_interval_mean"] + 4 * self.timing["flip_interval_sd"]) * self.refresh_rate)
+            self.frame_timer = FrameTimer(self.win, self.refresh_rate, self.long_frame, self.input)
+
+            # Formating
+            self.win_height = self.win.size[1]
+            self.bowl_size = self.win_height * bowl_size
+            # ___ Stimuli ___
+            # Wait (with a loading screen) for the background loader, then upload the textures (GL needs the main thread)
+            self.loading_message = visual.TextStim(self.win, height=0.075, color="white")
+            self.assets.prepare(self.win.size, self.bowl_size, self.timing["window_size"][1] / GARNISH_HEIGHT)
+            while not self.backend.wait_event(self.assets.ready, 1 / self.refresh_rate):
+                self.loading_screen(self.assets.progress / 2)
+            assets = self.assets.result()
+
+            if "bowl" in assets:
+                from PIL import Image
+                self.bowl = visual.ImageStim(self.win, image=Image.fromarray(assets["bowl"]), size=self.bowl_size, units="pix")
+            else:
+                self.bowl = visual.Circle(self.win, color="white", size=self.bowl_size, units="pix")
+            self.bowl_go_visualisation = visual.Circle(self.win, color="black", size=self.bowl_size + 20, units="pix")
+            self.soup = visual.Circle(self.win, fillColor="black", size=self.bowl_size * 0.8, units="pix")
+
+            # Shapes
+            self.shapes = {
+                "sterren": visual.ShapeStim(
+                        self.win, vertices=assets["star_vertices"],
+                        fillColor="black", lineColor="black", units="pix"
+                    ),
+                "driehoeken":
+                    visual.Polygon(
+                        self.win, edges=3, size=self.bowl_size/7,
+                        color="black", units="pix",
+                    ),
+                "cirkels":
+                    visual.Circle(
+                        self.win, size=self.bowl_size/7,
+                        color="black", units="pix",
+                    ),
+                "vierkanten":
+                    visual.Rect(
+                        self.win, size=math.sqrt((self.bowl_size ** 2) / 2)/7,
+                        color="black", units="pix",
+                    ),
+            }
 
-        # Text
-        self.message = visual.TextStim(self.win, color="white", height=0.075, wrapWidth=self.win_height/800)
+            self.garnish_pos = [tuple(pos) for pos in assets["garnish_pos"].tolist()]
+            self.garnish_ori = [0, 40, 60, 10, 75, 50, 5]
+
+            # Pre-composited stimuli: bowl, soup and garnish are rendered once per combination, so every trial is one blit
+            with self.tracer.span("stimulus_cache_maker"):
+                self.stimulus_cache = self.stimulus_cache_maker()
+
+            # ___ Participant: stimulus order, datafile (streamed per trial) and score keeping ___
+            self.save_directory = save_directory
+            self.data_format = data_format
+            self.columnar = columnar
+            self.schedule_seed = schedule_seed
+            self.schedule_library = schedule_library
+            self.input_samples = input_samples
+            if record:
+                self.backend.mark_startup()
+            self.start_participant()
+
+            # Text
+            self.text_cache = TextCache(self.win, visual.TextStim, wrap_width=self.win_height/800)
+            # Feedback is shown on every trial: lay it out once at startup
+            for feedback_points in ("+10", "+1", "-1", "-10"):
+                self.message_stim(feedback_points, size=0.2)
+            for feedback_text in ("grabbed", "thrown away", "did nothing"):
+                for extra_info in ("Correct!", "Fout!"):
+                    self.message_stim(feedback_text, extra_info=extra_info, pos=(0, -0.2))
+            self.questionnaire = Questionnaire(self.win, main_exp=self)
+        except KeyboardInterrupt:
+            self.quit_early(message=False)
+
+    def start_participant(self) -> None:
+        """
+        Sets up everything that belongs to one participant (after participant info and block order are known): order of
+        colors and shapes, datafile, score and running statistics
+        :return: None
+        """
+        # Order of colors and shapes (and thus which ones are used in which block) comes from the schedule
+        from RPEP_schedule import participant_stimulus_order
+        self.schedule = None  # Loaded by trial_maker
+        stimulus_order = participant_stimulus_order(int(self.part_nr), self.schedule_seed)
+        self.all_colors = [COLORS[i] for i in stimulus_order["color_order"]]
+        self.shape_names = [list(self.shapes.keys())[i] for i in stimulus_order["shape_order"]]  # Easier randomization
+
+        if self.save_directory is None:
+            self.data_writer = None
+        else:
+            self.data_writer = DataWriter(
+                self.save_directory + ("Dry_run" if self.backend.responder else "") + ("Developer_mode" if self.devstats else "") + self.part_nr,
+                header={**self.participant_data(), "date": self.backend.date(), "blocks": " ".join(self.blocks)},
+                file_format=self.data_format, columnar=self.columnar
+            )
+            if self.record:
+                self.backend.path = self.data_writer.path.rsplit(".", 1)[0] + "_replay.json.gz"
+        # Input samples of the previous participant are complete: the input thread continues with the new file
+        sampler, self.input.sampler = self.input.sampler, None
+        if sampler:
+            sampler.close()
+        if self.input_samples and self.data_writer:
+            self.input.sampler = InputSampler(self.data_writer.path.rsplit(".", 1)[0] + "_input.npy", self.frame_timer,
+                                              self.input.samples_per_second(self.refresh_rate))
+        # Resumed session: continues at the first trial of each block that is not in the datafile yet (the schedule of
+        # this participant is the same again), with the score of the trials before
+        done = self.data_writer.rows if self.data_writer else []
+        self.trials_done = {}
+        for row in done:
+            self.trials_done[row["block_type"]] = max(self.trials_done.get(row["block_type"], 0), int(row["trial_nr"]) + 1)
+        self.total_score = sum(int(row["feedback"]) for row in done)
+        self.n_correct_trials = sum(int(row["accuracy"]) for row in done)
+        # Developer mode: running statistics next to the datafile (python RPEP_monitor.py <file> follows them), else on stdout
+        stats_output = None
+        if self.devstats:
+            stats_output = self.data_writer.path.rsplit(".", 1)[0] + "_stats.jsonl" if self.data_writer else sys.stdout
+        self.stats = OnlineStats(stats_output)
 
-        # ___ Exp handler and score keeping ___
-        self.exp_handler = data.ExperimentHandler(
-            dataFileName=save_directory + ("Developer_mode" if self.devstats else "") + self.part_nr
-        )
-        self.total_score = 0
-        self.n_correct_trials = 0
+    def next_participant(self) -> None:
+        """
+        Prepares the next participant of a session: window, stimuli and laid-out text stay loaded, everything of the
+        previous participant is replaced (participant info, block order, stimulus order, datafile, score, timing)
+        :return: None
+        """
+        try:
+            # The participant dialog would be hidden behind the fullscreen window; the escape that cancels it is not
+            # for the experiment (the input thread still reads the keyboard)
+            self.win.winHandle.set_visible(False)
+            self.input.escape_from = math.inf
+            if self.record:
+                self.part_nr, self.gender, self.age, self.color_blind = self.backend.next_participant()
+            else:
+                self.part_nr, self.gender, self.age, self.color_blind = self.backend.participant_info()
+            self.input.escape_from = self.input.device.time()
+            self.win.winHandle.set_visible(True)
+            self.blocks = ["congruent", "incongruent"] if not int(self.part_nr) % 2 else ["incongruent", "congruent"]
+
+            self.frame_timer = FrameTimer(self.win, self.refresh_rate, self.long_frame, self.input)
+            self.tracer = Tracer(enabled=self.tracer.enabled)
+            self.questionnaire.hovered = None
+            self.start_participant()
+        except KeyboardInterrupt:
+            self.quit_early()
+
+    def run_session(self, n_participants=None, **main_settings) -> None:
+        """
+        Runs participants one after another in the same window (no restart of RPEP.py in between)
+        :param n_participants: Amount of participants (None: until the participant dialog is cancelled)
+        :param main_settings: Arguments of main
+        :return: None
+        """
+        participant = 0
+        while n_participants is None or participant < n_participants:
+            if participant:
+                self.next_participant()
+            self.main(**main_settings)
+            participant += 1
 
     def communication(self, text_key: str, n_block: int=-1, shapes: tuple=None, colors: tuple=None, extra_info=None, pos: tuple=(0, 0),
                       wait_resp=True, color="white", size=0.075, flip=True, block_type="", n_trials=-1, wait_time=0.0) -> None:
@@ -282,6 +1933,47 @@ class Exp:
         :param wait_time: Duration to pause the game (only if wait_resp=False)
         :return: None
         """
+        with self.tracer.span("communication", text_key=text_key):
+            self.message_stim(text_key, n_block, shapes, colors, extra_info, pos, color, size, block_type, n_trials).draw()
+        if flip:
+            self.frame_timer.flip("communication")
+        if wait_resp or wait_time:
+            self.frame_timer.pause()
+
+        if wait_resp:
+            self.input.start("communication")
+            self.continue_keys.wait()
+            self.input.stop()
+        elif wait_time:
+            self.backend.wait(wait_time)
+
+    def message_stim(self, text_key: str, n_block: int=-1, shapes: tuple=None, colors: tuple=None, extra_info=None,
+                     pos: tuple=(0, 0), color="white", size=0.075, block_type="", n_trials=-1):
+        """
+        Returns the (cached) ready-to-draw TextStim of a message; see communication() for the parameters
+        :return: TextStim
+        """
+        if text_key in ("+10", "+1"):
+            color = "green"
+        elif text_key in ("-10", "-1"):
+            color = "red"
+        elif text_key == "0":
+            color = "black"
+        format_args = (n_block, shapes, colors, extra_info, block_type, n_trials)
+        if text_key == "end":
+            format_args += (self.n_correct_trials, self.total_score)
+
+        return self.text_cache.get(
+            (text_key, format_args, color, size, pos),
+            lambda: self.message_text(text_key, n_block, shapes, colors, extra_info, block_type, n_trials),
+            color, size, pos
+        )
+
+    def message_text(self, text_key: str, n_block: int, shapes: tuple, colors: tuple, extra_info, block_type: str, n_trials: int) -> str:
+        """
+        Builds the text of a message; see communication() for the parameters
+        :return: Text of the message
+        """
         if colors:
             color_translation = {
                 "yellow": "gele",
@@ -354,50 +2046,27 @@ class Exp:
             "-1": "-1",
             "-10": "-10",
         }
-        self.message.text = options[text_key]
-        if pos:
-            self.message.pos = pos
-        if text_key in ("+10", "+1"):
-            self.message.color = "green"
-        elif text_key in ("-10", "-1"):
-            self.message.color = "red"
-        elif text_key == "0":
-            self.message.color = "black"
-        else:
-            self.message.color = color
-        self.message.size = size
-
-        self.message.draw()
-        if flip:
-            self.win.flip()
+        return options[text_key]
 
-        if wait_resp:
-            response = event.waitKeys(keyList=["space", "escape"])[0]
-            if response == "escape":
-                self.communication("early_quit")
-                core.quit()
-        else:
-            core.wait(wait_time)
-            if text_key != "early_quit":
-                self.escape_check()
-
-    def escape_check(self, response=""):
-        if not response:
-            escape = event.getKeys(keyList="escape")
-        else:
-            escape = response
-        if "escape" in escape:
+    def quit_early(self, message=True) -> None:
+        """
+        Escape (InputDispatcher) or ctrl+c: shows the early quit message and stops (the datafile keeps all finished trials)
+        :param message: Shows the early quit message (False during the startup: the text is not laid out yet)
+        :return: None
+        """
+        self.input.stop()
+        self.backend.aborted()
+        if message:
             self.communication("early_quit", wait_resp=False, wait_time=1)
-            core.quit()
-        return 0
+        self.backend.quit()
 
     def trial_maker(self, n_trials: int, fix_cross_duration: list, block_type: str) -> tuple:
         """
         Creates n_trials amount of trials
-        :param fix_cross_duration: Duration of display of the fixation cross (list of min/max)
+        :param fix_cross_duration: Duration of display of the fixation cross (list of min/max, in ms; converted to frames)
         :param block_type: Are trials congruent or incongruent to Pavlovian bias?
         :param n_trials: Total amount of trials in 1 block
-        :return: TrialHandler with generated trials
+        :return: Go and NoGo shape, reward and punishment color, TrialTable with generated trials
         """
         # Pop shapes and colors from stim lists (will not be reused across blocks)
         shapes_this_block = {
@@ -409,41 +2078,43 @@ class Exp:
             "punishment": self.all_colors.pop()
         }
 
-        # Make trials
-        trial_list = []
-        counter = 1
-        for i in range(int(n_trials/8)):
-            new_part = []
-            for _ in range(2):
-                for response, incentive in zip(["Go", "NoGo"]*2, ["reward", "punishment", "punishment", "reward"]):
-                    new_part.append(
-                        {
-                            "block_type": block_type,
-                            "shape_name": shapes_this_block[response],
-                            "correct_response": response,
-                            "color": colors_this_block[incentive],
-                            "incentive": incentive,
-                            "fix_cross_time": random.randint(fix_cross_duration[0], fix_cross_duration[1]) / 1000,
-                            "order_per_8": counter%8 + 1 # Keep track of original order (before randomization, per 8)
-                        }
-                    )
-                    counter += 1
-            random.shuffle(new_part)
-            trial_list += new_part
-
-        # Add to TrialHandler and ExperimentHandler
-        trials = data.TrialHandler(trial_list, nReps=1, method="sequential")
-        self.exp_handler.addLoop(trials)
+        # Make trials from the schedule of this participant (positions 0-7 within the mini-block of 8, before shuffling)
+        from RPEP_schedule import RESPONSES, INCENTIVES
+        position, fix_cross_ms = self.load_schedule(n_trials, fix_cross_duration, self.blocks.index(block_type))
+        conditions = [
+            (shapes_this_block[RESPONSES[p % 4]], RESPONSES[p % 4], colors_this_block[INCENTIVES[p % 4]], INCENTIVES[p % 4])
+            for p in range(8)
+        ]
+        fix_cross_frames = [self.frames(duration / 1000) for duration in fix_cross_ms.tolist()]
+        trials = TrialTable(block_type, conditions, position.tolist(), fix_cross_frames)
 
-        if self.devstats:
-            trial_maker_devstats(trials, trial_list)
+        self.stats.block(trials)
 
         return (shapes_this_block["Go"], shapes_this_block["NoGo"]), (colors_this_block["reward"], colors_this_block["punishment"]), trials
 
 
-    def trial_runner(self, trials, feedback_duration: float, response_deadline: float, intertrial_interval: float, times_instructions_read) -> None:
+    def load_schedule(self, n_trials: int, fix_cross_duration: list, n_block: int) -> tuple:
+        """
+        Schedule of one block of this participant: from the schedule library if it is in there, else generated
+        :param n_trials: Total amount of trials in 1 block
+        :param fix_cross_duration: Min and Max fixation duration (ms)
+        :param n_block: Block number (0 based)
+        :return: array of mini-block positions (0-7), array of fixation durations (ms)
+        """
+        from RPEP_schedule import library_schedule, participant_schedule
+        settings = (n_trials, tuple(fix_cross_duration))
+        if self.schedule is None or self.schedule[0] != settings:
+            participant_nr = int(self.part_nr)
+            schedule = (library_schedule(self.schedule_library, participant_nr, n_trials, fix_cross_duration, self.schedule_seed)
+                        or participant_schedule(participant_nr, n_trials, fix_cross_duration, self.schedule_seed, len(self.blocks)))
+            self.schedule = (settings, schedule)
+        return self.schedule[1]["position"][n_block], self.schedule[1]["fix_cross_ms"][n_block]
+
+    def trial_runner(self, trials, feedback_duration: float, response_deadline: float, intertrial_interval: float, times_instructions_read,
+                     first_trial=0) -> None:
         """
         Show created trials, wait for (optional) response and store data in file
+        :param first_trial: Trial to start at (resumed session: the trials before are in the datafile)
         :param times_instructions_read: Amount of times participants read instructions
         :param intertrial_interval: Time between feedback and next fixation cross appearing
         :param trials: Trials created using self.trial_maker()
@@ -451,73 +2122,291 @@ class Exp:
         :param feedback_duration: Time (s) during which feedback and result of action is displayed
         :return: None
         """
-        for i, trial in enumerate(trials):
+        # Durations in frames (phases are timed by counting flips)
+        iti_frames = self.frames(intertrial_interval)
+        stimulus_frames = self.frames(response_deadline)
+        feedback_frames = self.frames(feedback_duration)
+
+        self.frame_timer.next_trial(first_trial, trials.block_type)
+        iti_onset = self.frame_timer.flip("iti")  # Blank screen: start of the first intertrial interval
+        for i in range(first_trial, len(trials)):
+            trial = trials[i]
             # ___ TRIAL ___
-            # Intertrial interval
+            with self.tracer.span("trial", trial_nr=i, block_type=trial["block_type"]):
+                # Intertrial interval (its first blank frame is already on screen)
+                self.present(None, iti_frames - 1, "iti")
+                # Draw bowl with soup
+                fixation_onset = self.present(lambda: self.draw_stimuli(trial), trial["fix_cross_frames"], "fixation")
+
+                # Put garnish shapes on top (onset and keyboard clock are stamped on the first flip)
+                self.response_collector.arm()
+
+                # ___ RESPONSE ___
+                # Keep presenting the stimulus every frame and poll the keyboard in between, until response deadline
+                key = None
+                stimulus_onset = None
+                with self.tracer.span("stimulus"):
+                    for frame in range(stimulus_frames):
+                        if frame and not key:
+                            with self.tracer.span("poll"):
+                                key = self.response_collector.poll(response_deadline)
+                        self.draw_stimuli(trial, garnish=True, bowl_action=bool(key))
+                        flip_time = self.frame_timer.flip("stimulus")
+                        if not frame:
+                            stimulus_onset = flip_time
+                key = key or self.response_collector.poll(response_deadline)  # Key pressed during the final frame
+                self.response_collector.disarm()
+
+                response = key.name if key else None
+                response_time = key.rt if key else None
+
+                # ___ FEEDBACK AND DATA ___
+                with self.tracer.span("outcome_handler"):
+                    accuracy, feedback_points, feedback_text = self.outcome_handler(trial, response, response_time)
+                with self.tracer.span("message_stim"):
+                    feedback_stims = [
+                        self.message_stim(feedback_points, size=0.2),
+                        self.message_stim(feedback_text, extra_info="Correct!" if accuracy else "Fout!", pos=(0, -0.2))
+                    ]
+                feedback_onset = self.present(lambda: [stim.draw() for stim in feedback_stims], feedback_frames, "feedback")
+                frame_quality = self.frame_timer.next_trial(i + 1, trial["block_type"])
+                next_iti_onset = self.frame_timer.flip("iti")  # Blank screen: ends the feedback and starts the next intertrial interval
+
+                # Add data to datafile (participant info is in the header of the datafile)
+                with self.tracer.span("data"):
+                    row = {"trial_nr": i, **trial, **self.trial_data(trial, response, response_time, accuracy, feedback_points, times_instructions_read)}
+                    row["stimulus_onset"] = self.response_collector.onset  # float, psychopy clock (s)
+                    row["keypress_time"] = key.tDown if key else None  # float, same clock as stimulus_onset
+
+                    # Timing: intended vs achieved number of frames per phase (achieved: from phase onset to next phase onset)
+                    frames_intended = {"iti": iti_frames, "fixation": trial["fix_cross_frames"], "stimulus": stimulus_frames, "feedback": feedback_frames}
+                    phase_onsets = [iti_onset, fixation_onset, stimulus_onset, feedback_onset, next_iti_onset]
+                    for (phase, n_frames), onset, next_onset in zip(frames_intended.items(), phase_onsets, phase_onsets[1:]):
+                        row[f"{phase}_frames_intended"] = n_frames
+                        row[f"{phase}_frames_achieved"] = self.frames(next_onset - onset)
+                    # Timing quality: frames longer than 1.5 refresh intervals and the longest frame of the trial (s)
+                    row.update(frame_quality)
+                    row["timing_ok"] = int(not frame_quality["dropped_frames"] and all(
+                        row[f"{phase}_frames_achieved"] == n_frames for phase, n_frames in frames_intended.items()
+                    ))
+                    iti_onset = next_iti_onset
+                    if self.data_writer:
+                        self.data_writer.write(row)
+        self.frame_timer.next_trial(None)
+
+    def stimulus_cache_maker(self) -> dict:
+        """
+        Renders every combination of soup color, garnish shape and bowl action once and captures it as a single image
+        :return: dictionary of (color, shape_name, bowl_action) -> BufferImageStim (shape_name None: soup without garnish)
+        """
+        # Part of the back buffer that contains the stimulus (incl. Go visualisation), in norm units [left, top, right, bottom]
+        half_width = (self.bowl_size + 24) / self.win.size[0]
+        half_height = (self.bowl_size + 24) / self.win.size[1]
+        rect = [-half_width, half_height, half_width, -half_height]
+
+        cache = {}
+        for i, color in enumerate(COLORS):
+            self.soup.color = color
+            for shape_name in [None] + list(self.shapes):
+                for bowl_action in ([False] if shape_name is None else [False, True]):
+                    self.win.clearBuffer()
+                    self.compose_stimulus(shape_name, bowl_action)
+                    cache[(color, shape_name, bowl_action)] = self.visual.BufferImageStim(self.win, buffer="back", rect=rect)
+            self.win.clearBuffer()
+            self.loading_screen(0.5 + (i + 1) / len(COLORS) / 2)
+        return cache
+
+    def load_timing_profile(self, path, recalibrate=False) -> dict:
+        """
+        Timing profile of this machine: from the cache if this display configuration was calibrated before, else
+        measured (calibrate) and cached
+        :param path: Cache of the timing profiles (json; None: no cache)
+        :param recalibrate: Calibrates again, even if cached
+        :return: dictionary (see calibrate)
+        """
+        display = self.backend.display_config(self.win)
+        key = json.dumps(display, sort_keys=True)
+        profiles = {}
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                profiles = json.load(file)
+        profile = self.backend.timing_profile(self.win, None if recalibrate else profiles.get(key))
+        if profile is not None and display.get("refresh_rate") is None:
+            # The screen mode does not tell the refresh rate: a short measurement checks that it did not change
+            refresh_rate = self.win.getActualFrameRate(nIdentical=10, nMaxFrames=60)
+            if refresh_rate and abs(refresh_rate - profile["refresh_rate"]) > 1:
+                profile = None
+        if profile is None:
+            profile = self.calibrate()
+            if path:
+                # Write and rename: an interrupted save leaves no broken cache file
+                profiles[key] = profile
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".tmp", "w", encoding="utf-8") as file:
+                    json.dump(profiles, file, indent=1)
+                os.replace(path + ".tmp", path)
+        return profile
+
+    def calibrate(self, n_frames=120, n_presses=5) -> dict:
+        """
+        Measures the timing of the display and keyboard (a few seconds, and n_presses presses of the space bar)
+        :param n_frames: Amount of frames per measurement
+        :param n_presses: Amount of key presses
+        :return: dictionary of refresh_rate (Hz), flip_interval_mean, _sd and _max, text_draw and shape_draw (median
+                 duration of a draw), key_latency_mean and _max (from the keyboard timestamp until the key reaches the
+                 experiment), all in s, window_size (pix) and date
+        """
+        message = self.visual.TextStim(self.win, text="Kalibratie van het scherm...", height=0.075, color="white")
+        shape = self.visual.Circle(self.win, color="white", size=self.win.size[1] / 2, units="pix")
+        refresh_rate = self.win.getActualFrameRate()
+
+        # Frames with only the message on screen
+        flip_times = []
+        for frame in range(n_frames + 1):
+            message.draw()
+            flip_times.append(self.win.flip())
+        intervals = [flip_time - previous for previous, flip_time in zip(flip_times, flip_times[1:])]
+        if not refresh_rate:
+            # No stable frame rate found by psychopy: from the flip intervals (median: a dropped frame does not count)
+            refresh_rate = 1 / statistics.median(intervals)
+
+        # Draw duration of a shape and of text (the message stays on screen)
+        draw_durations = {"shape_draw": [], "text_draw": []}
+        for frame in range(n_frames):
+            start = self.backend.get_time()
+            shape.draw()
+            between = self.backend.get_time()
+            message.draw()
+            draw_durations["shape_draw"].append(between - start)
+            draw_durations["text_draw"].append(self.backend.get_time() - between)
             self.win.flip()
-            core.wait(intertrial_interval)
-            # Draw bowl with soup
-            self.soup.color = trial["color"]
-            self.draw_stimuli(trial)
-            core.wait(trial["fix_cross_time"])
-
-            # Put garnish shapes on top
-            self.timer.reset()
-            self.escape_check()
-
-            self.draw_stimuli(trial, garnish=True)
-
-            # ___ RESPONSE ___
-            self.timer.reset()
-
-            response = event.waitKeys(keyList=["space", "escape"], maxWait=response_deadline)
-
-            response_time = self.timer.getTime()
-            self.escape_check(response)
-            if response:
-                self.draw_stimuli(trial, garnish=True, bowl_action=True)
-
-            # If Go before response_deadline: keep displaying stimulus for remaining time (skips if crossed deadline (negative value))
-            core.wait(response_deadline - self.timer.getTime())
-
-            # ___ FEEDBACK AND DATA ___
-            accuracy, feedback_points, feedback_text = self.outcome_handler(trial, response, response_time)
-            self.communication(feedback_points, wait_resp=False, size=0.2, flip=False)
-            self.communication(feedback_text, extra_info="Correct!" if accuracy else "Fout!", wait_resp=False, pos=(0, -0.2,), wait_time=feedback_duration)
-            self.escape_check()
-
-            # Add data to datafile
-            trials.addData("incentive", trial["incentive"])  # reward/punishment
-            trials.addData("block_type", trial["block_type"])  # congruent/incongruent
-            trials.addData("given_response", "Go" if response else "NoGo")  # Go/NoGo
-            trials.addData("accuracy", int(accuracy))  # 0/1
-            trials.addData("feedback", feedback_points)  # +10/0/-10
-            trials.addData("response_time", response_time if response_time <= response_deadline else None)  # float
-
-            # General information
-            trials.addData("participant_nr", self.part_nr)
-            trials.addData("participant_gender", self.gender)
-            trials.addData("participant_age", self.age)
-            trials.addData("colorblind", 1 if self.color_blind == "Ja" else 0)
-            trials.addData("times_instructions_read", times_instructions_read)
-            self.exp_handler.nextEntry()
 
-    def draw_stimuli(self, trial, garnish=False, bowl_action=False):
+        # Keyboard: time since the start of the press (rt, keyboard timestamp) until the key arrives here
+        latencies = []
+        for press in range(n_presses):
+            message.text = f"Kalibratie van het toetsenbord: druk op de spatiebalk ({press + 1}/{n_presses})"
+            message.draw()
+            self.win.flip()
+            self.input.start("calibration")
+            start = self.backend.get_time()
+            keys = self.calibration_keys.wait(0.001)
+            latencies.append(self.backend.get_time() - start - keys[0][1])
+        self.input.stop()
+        self.win.flip()
+
+        return {
+            "refresh_rate": refresh_rate,
+            "flip_interval_mean": statistics.fmean(intervals),
+            "flip_interval_sd": statistics.stdev(intervals),
+            "flip_interval_max": max(intervals),
+            **{name: statistics.median(durations) for name, durations in draw_durations.items()},
+            "key_latency_mean": statistics.fmean(latencies),
+            "key_latency_max": max(latencies),
+            "window_size": [int(n) for n in self.win.size],
+            "date": self.backend.date(),
+        }
+
+    def loading_screen(self, progress: float) -> None:
+        """
+        Shows how far the stimuli are loaded (flips the window)
+        :param progress: Fraction loaded (0-1)
+        :return: None
+        """
+        self.loading_message.text = f"Laden... {round(progress * 100)}%"
+        self.loading_message.draw()
+        self.frame_timer.flip("loading")
+        self.frame_timer.pause()  # Loading frames are not timed
+
+    def compose_stimulus(self, shape_name=None, bowl_action=False):
+        """
+        Draws bowl, soup and (optionally) 7 garnish shapes separately; only used to fill the stimulus cache
+        :param shape_name: Name of the garnish shape (None for no garnish)
+        :param bowl_action: Draws the Go visualisation around the bowl if True
+        :return: None
+        """
         if bowl_action: self.bowl_go_visualisation.draw()
         self.bowl.draw()
         self.soup.draw()
-        if garnish:
-            shape = self.shapes[trial["shape_name"]]
+        if shape_name:
+            shape = self.shapes[shape_name]
             for pos, ori in zip(self.garnish_pos, self.garnish_ori):
                 shape.pos = pos
                 shape.ori = ori
                 shape.draw(self.win)
-        self.win.flip()
+
+    def participant_data(self) -> dict:
+        """
+        Static participant information (header of the datafile)
+        :return: dictionary of name -> value
+        """
+        return {
+            "participant_nr": self.part_nr,
+            "participant_gender": self.gender,
+            "participant_age": self.age,
+            "colorblind": 1 if self.color_blind == "Ja" else 0,
+        }
+
+    def trial_data(self, trial, response, response_time, accuracy, feedback_points, times_instructions_read) -> dict:
+        """
+        Collects the response columns of one trial for the datafile (also used by RPEP_simulation)
+        :param trial: trial (record of a TrialTable)
+        :param response: pressed key (Space or None)
+        :param response_time: If Go: time elapsed between stimulus onset and button press, None if NoGo
+        :param accuracy: Result of outcome_handler
+        :param feedback_points: Result of outcome_handler
+        :param times_instructions_read: Amount of times participants read instructions
+        :return: dictionary of column name -> value
+        """
+        return {
+            "incentive": trial["incentive"],  # reward/punishment
+            "block_type": trial["block_type"],  # congruent/incongruent
+            "given_response": "Go" if response else "NoGo",  # Go/NoGo
+            "accuracy": int(accuracy),  # 0/1
+            "feedback": feedback_points,  # +10/0/-10
+            "response_time": response_time,  # float
+            "times_instructions_read": times_instructions_read,
+        }
+
+    def draw_stimuli(self, trial, garnish=False, bowl_action=False):
+        """
+        Draws the pre-composited stimulus of this trial (without flipping)
+        :param trial: trial (record of a TrialTable)
+        :param garnish: Draws soup with garnish shapes if True, only the soup otherwise
+        :param bowl_action: Draws the Go visualisation around the bowl if True
+        :return: None
+        """
+        self.stimulus_cache[(trial["color"], trial["shape_name"] if garnish else None, bowl_action)].draw()
+
+    def frames(self, duration: float) -> int:
+        """
+        Converts a duration to the closest number of frames at the measured refresh rate
+        :param duration: Duration (s)
+        :return: Number of frames
+        """
+        return round(duration * self.refresh_rate)
+
+    def present(self, draw, n_frames: int, phase: str):
+        """
+        Presents a phase for an exact number of frames by counting flips (no sleeping)
+        :param draw: Draws the content of one frame (without flipping); None for a blank screen
+        :param n_frames: Number of frames the phase lasts
+        :param phase: Name of the phase (for the frame timing)
+        :return: Time of the first flip (phase onset); None if n_frames is 0
+        """
+        onset = None
+        with self.tracer.span(phase):
+            for frame in range(n_frames):
+                if draw:
+                    draw()
+                flip_time = self.frame_timer.flip(phase)
+                if not frame:
+                    onset = flip_time
+        return onset
 
     def outcome_handler(self, trial, response, response_time) -> tuple:
         """
         Calculates outcome of trial, based on response
-        :param trial: trial within TrialHandler object
+        :param trial: trial (record of a TrialTable)
         :param response: pressed key (Space or None)
         :param response_time: If Go: time elapsed between stimulus presentation and button press, None if NoGo
         :return: accuracy (0 or 1) and given feedback (of which 80% is correct)
@@ -545,9 +2434,8 @@ class Exp:
 
         feedback_text = ("grabbed" if trial["block_type"] == "congruent" else "thrown away") if response else "did nothing"
 
-        # Optional: print details if devstats == True
-        if self.devstats:
-            trial_runner_devstats(trial, feedback_points, accuracy, response, response_time)
+        # Running statistics (written on a background thread if devstats == True)
+        self.stats.update(trial, response, response_time, accuracy, feedback_points)
 
         return accuracy, feedback_points, feedback_text
 
@@ -563,45 +2451,104 @@ class Exp:
         :param response_deadline: Max time to give a response
         :return: None
         """
-        self.communication("intro")
-
-        for i, block_type in enumerate(self.blocks):
-            # Create trials
-            shapes, colors, trials_this_block = self.trial_maker(n_trials_per_block, fix_cross_duration, block_type=block_type)
-
-            # Instructions and questionnaire until all questions correctly answered
-            all_correct = False
-            times_instructions_read = 1
-            while not all_correct:
-                self.communication(text_key="general", n_block=i, colors=colors)
-                self.communication(text_key=block_type, shapes=shapes, colors=colors, n_block=i)
-                self.communication("overview", shapes=shapes, colors=colors, block_type=block_type)
-
-                # Questionnaire itself
-                all_correct = Questionnaire(self.win, main_exp=self).ask(correct_answers=[colors[1], shapes[0], block_type], repeat_intro=not times_instructions_read - 1, block_type=block_type)
-                if not all_correct:
-                    self.communication("question_wrong")
-                    times_instructions_read += 1
-                else:
-                    self.communication("start_trials", n_block=i)
-            # Run trials
-            self.trial_runner(trials_this_block, feedback_duration, response_deadline, intertrial_interval, times_instructions_read)
-
-            # Give break (except after the final block)
-            if i != len(self.blocks) - 1:
-                self.communication("break")
-        self.communication("end", n_trials=n_trials_per_block*len(self.blocks))
+        if self.record:
+            self.backend.settings["main"] = {
+                "n_trials_per_block": n_trials_per_block, "fix_cross_duration": list(fix_cross_duration),
+                "feedback_duration": feedback_duration, "response_deadline": response_deadline,
+                "intertrial_interval": intertrial_interval
+            }
+        try:
+            self.communication("intro")
+
+            for i, block_type in enumerate(self.blocks):
+                # Create trials
+                with self.tracer.span("trial_maker", block_type=block_type):
+                    shapes, colors, trials_this_block = self.trial_maker(n_trials_per_block, fix_cross_duration, block_type=block_type)
+                first_trial = self.trials_done.get(block_type, 0)
+                if first_trial >= len(trials_this_block):
+                    continue  # Finished before the session was resumed
+
+                # Instructions and questionnaire until all questions correctly answered
+                all_correct = False
+                times_instructions_read = 1
+                while not all_correct:
+                    self.communication(text_key="general", n_block=i, colors=colors)
+                    self.communication(text_key=block_type, shapes=shapes, colors=colors, n_block=i)
+                    self.communication("overview", shapes=shapes, colors=colors, block_type=block_type)
+
+                    # Questionnaire itself
+                    with self.tracer.span("questionnaire"):
+                        all_correct = self.questionnaire.ask(correct_answers=[colors[1], shapes[0], block_type], repeat_intro=not times_instructions_read - 1, block_type=block_type)
+                    if not all_correct:
+                        self.communication("question_wrong")
+                        times_instructions_read += 1
+                    else:
+                        self.communication("start_trials", n_block=i)
+                # Run trials
+                with self.tracer.span("trial_runner", block_type=block_type):
+                    self.trial_runner(trials_this_block, feedback_duration, response_deadline, intertrial_interval, times_instructions_read, first_trial)
+
+                # Give break (except after the final block)
+                if i != len(self.blocks) - 1:
+                    self.communication("break")
+            self.stats.close()
+            if self.data_writer:
+                self.data_writer.close(complete=True)
+                # Frame timing of the session next to the datafile
+                with open(self.data_writer.path.rsplit(".", 1)[0] + "_frames.json", "w", encoding="utf-8") as file:
+                    json.dump({**self.frame_timer.summary(), "timing_profile": self.timing}, file, indent=1)
+                if self.tracer.enabled:
+                    self.tracer.export(self.data_writer.path.rsplit(".", 1)[0] + "_trace.json")
+            if self.input.sampler:
+                self.input.sampler.close()
+            if self.record:
+                self.backend.save()
+            self.communication("end", n_trials=n_trials_per_block*len(self.blocks))
+        except KeyboardInterrupt:
+            self.quit_early()
 
 if __name__ == "__main__":
-    Exp(
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true", help="Run without display on a virtual clock, random responses")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the random responses in a dry run")
+    parser.add_argument("--data-format", choices=["csv", "jsonl"], default="csv", help="Format of the datafile")
+    parser.add_argument("--columnar", action="store_true", help="Also save the completed session as .parquet")
+    parser.add_argument("--trace", action="store_true", help="Save a Chrome trace (chrome://tracing) of the session")
+    parser.add_argument("--schedule-seed", type=int, default=0, help="Seed of the trial schedules")
+    parser.add_argument("--session", action="store_true", help="Keep the window open and run participants one after another")
+    parser.add_argument("--participants", type=int, default=None, help="Amount of participants of a session (default: until cancelled)")
+    parser.add_argument("--record", action="store_true", help="Record seeds and input, to replay the session (RPEP_replay.py)")
+    parser.add_argument("--input-samples", action="store_true", help="Sample keys and mouse next to the datafile (1000 Hz with psychtoolbox, else once per frame)")
+    parser.add_argument("--calibrate", action="store_true", help="Measure the timing of this machine again (also if cached)")
+    parser.add_argument("--schedule-library", default=os.path.join(os.getcwd(), "RPEP_schedules.npz"),
+                        help="Pregenerated schedules (RPEP_schedule.py); missing schedules are generated")
+    arguments = parser.parse_args()
+
+    experiment = Exp(
         bowl_size=0.5,  # Proportional to height of screen
         save_directory=os.path.join(os.getcwd(), "RPEP_data", f"data_"),
-        devstats=False  # Shows statistics and saves data separately; False for data collection
-    ).main(
+        devstats=False,  # Shows statistics and saves data separately; False for data collection
+        backend=DryRunBackend(responder=RandomResponder(seed=arguments.seed)) if arguments.dry_run else None,
+        data_format=arguments.data_format,
+        columnar=arguments.columnar,
+        asset_cache=os.path.join(os.getcwd(), "RPEP_cache"),
+        trace=arguments.trace,
+        schedule_seed=arguments.schedule_seed,
+        schedule_library=arguments.schedule_library,
+        record=arguments.record,
+        input_samples=arguments.input_samples,
+        timing_profile=os.path.join(os.getcwd(), "RPEP_cache", "timing_profile.json"),
+        recalibrate=arguments.calibrate
+    )
+    main_settings = dict(
         fix_cross_duration=[750, 1250],  # in milliseconds, [min duration, max duration]
         feedback_duration=1.5,  # in seconds
         response_deadline=1,  # in seconds
         intertrial_interval=0.5,  # in seconds
         n_trials_per_block=160,  # Must be divisible by 8
     )
+    if arguments.session:
+        experiment.run_session(arguments.participants, **main_settings)
+    else:
+        experiment.main(**main_settings)
 
@@ -0,0 +1,202 @@
+"""
+--------------------------
+
+Group-level analysis of the Pavlovian bias in the Go/NoGo task of RPEP.py
+
+Works on the trial columns of trial_runner (incentive, block_type, correct_response, given_response, accuracy,
+response_time, participant_nr) of collected or simulated participants. Everything is computed with grouped pandas/numpy
+operations over all participants at once; bootstrap confidence intervals are spread over a process pool.
+
+The input samples of a session (RPEP.py --input-samples) are read memory-mapped: presses() finds every press and release
+of a key or the mouse button per trial and phase.
+
+--------------------------
+"""
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy
+import pandas
+
+PARTICIPANT = ["participant_nr"]
+CELL = ["incentive", "correct_response"]
+
+
+def prepare(trials):
+    """
+    Adds the columns used by the analyses
+    :param trials: DataFrame with trials of one or more participants (in presented order)
+    :return: DataFrame with extra columns go (0/1) and mini_block (0-based number of the 8 trials within the block)
+    """
+    trials = trials.assign(
+        go=(trials["given_response"] == "Go").astype(int),
+        accuracy=pandas.to_numeric(trials["accuracy"]),
+        response_time=pandas.to_numeric(trials["response_time"], errors="coerce"),
+    )
+    return trials.assign(mini_block=trials.groupby(PARTICIPANT + ["block_type"], observed=True).cumcount() // 8)
+
+
+def go_bias(trials):
+    """
+    Pavlovian Go bias per participant and block type: P(Go | reward) - P(Go | punishment)
+    :param trials: DataFrame of prepare()
+    :return: DataFrame (index participant_nr, columns block types)
+    """
+    p_go = trials.groupby(PARTICIPANT + ["block_type", "incentive"], observed=True)["go"].mean().unstack("incentive")
+    return (p_go["reward"] - p_go["punishment"]).unstack("block_type")
+
+
+def accuracy_cells(trials):
+    """
+    Accuracy per participant for every incentive x correct_response x block_type cell
+    :param trials: DataFrame of prepare()
+    :return: DataFrame (index participant_nr, columns (incentive, correct_response, block_type))
+    """
+    return trials.groupby(PARTICIPANT + CELL + ["block_type"], observed=True)["accuracy"].mean().unstack(CELL + ["block_type"])
+
+
+def congruency_effect(trials):
+    """
+    Congruent - incongruent difference per participant of the Go bias and of the accuracy per cell
+    :param trials: DataFrame of prepare()
+    :return: DataFrame (index participant_nr)
+    """
+    bias = go_bias(trials)
+    accuracy = trials.groupby(PARTICIPANT + CELL + ["block_type"], observed=True)["accuracy"].mean().unstack("block_type")
+    accuracy_difference = (accuracy["congruent"] - accuracy["incongruent"]).unstack(CELL)
+    accuracy_difference.columns = [f"accuracy_{incentive}_{response}" for incentive, response in accuracy_difference.columns]
+    return accuracy_difference.assign(go_bias=bias["congruent"] - bias["incongruent"])
+
+
+def rt_quantiles(trials, quantiles=(0.1, 0.3, 0.5, 0.7, 0.9)):
+    """
+    Response time quantiles of the Go responses per participant, block type and incentive
+    :param trials: DataFrame of prepare()
+    :param quantiles: Quantiles to compute
+    :return: DataFrame (index participant_nr, block_type, incentive; columns quantiles)
+    """
+    go_trials = trials[trials["go"] == 1]
+    return (go_trials.groupby(PARTICIPANT + ["block_type", "incentive"], observed=True)["response_time"]
+            .quantile(list(quantiles)).unstack())
+
+
+def learning_curve(trials):
+    """
+    Accuracy per mini-block of 8 trials for every cell, averaged over participants
+    :param trials: DataFrame of prepare()
+    :return: DataFrame (index block_type, mini_block; columns (incentive, correct_response))
+    """
+    per_participant = trials.groupby(PARTICIPANT + ["block_type", "mini_block"] + CELL, observed=True)["accuracy"].mean()
+    return per_participant.groupby(["block_type", "mini_block"] + CELL, observed=True).mean().unstack(CELL)
+
+
+def participant_measures(trials):
+    """
+    All measures per participant in one wide table (input of bootstrap_ci)
+    :param trials: DataFrame of prepare()
+    :return: DataFrame (index participant_nr, one column per measure)
+    """
+    bias = go_bias(trials).add_prefix("go_bias_")
+    accuracy = accuracy_cells(trials)
+    accuracy.columns = ["accuracy_" + "_".join(column) for column in accuracy.columns]
+    congruency = congruency_effect(trials).add_prefix("congruency_")
+    median_rt = rt_quantiles(trials, quantiles=(0.5,))[0.5].unstack(["block_type", "incentive"])
+    median_rt.columns = ["median_rt_" + "_".join(column) for column in median_rt.columns]
+    return pandas.concat([bias, accuracy, congruency, median_rt], axis=1)
+
+
+def bootstrap_worker(values, n_resamples: int, seed):
+    """
+    Means of n_resamples resamples (with replacement) of the participants
+    :param values: Array (participants x measures)
+    :param n_resamples: Amount of resamples
+    :param seed: numpy SeedSequence of this worker
+    :return: Array (n_resamples x measures)
+    """
+    generator = numpy.random.default_rng(seed)
+    means = numpy.empty((n_resamples, values.shape[1]))
+    batch = max(1, 4_000_000 // values.size)  # Resamples per batch (limits memory use)
+    for start in range(0, n_resamples, batch):
+        stop = min(start + batch, n_resamples)
+        indices = generator.integers(0, len(values), size=(stop - start, len(values)))
+        means[start:stop] = numpy.nanmean(values[indices], axis=1)
+    return means
+
+
+def bootstrap_ci(measures, n_resamples=10000, confidence=0.95, workers=None, seed=0):
+    """
+    Group mean and percentile bootstrap confidence interval of every measure (resampling participants)
+    :param measures: DataFrame of participant_measures()
+    :param n_resamples: Amount of bootstrap resamples
+    :param confidence: Confidence level of the interval
+    :param workers: Amount of worker processes (default: amount of cores)
+    :param seed: Seed of the resampling
+    :return: DataFrame (index measures; columns mean, ci_lower, ci_upper)
+    """
+    values = measures.to_numpy(dtype=float)
+    n_chunks = workers or os.cpu_count() or 1
+    chunk_sizes = [n_resamples // n_chunks + (chunk < n_resamples % n_chunks) for chunk in range(n_chunks)]
+    seeds = numpy.random.SeedSequence(seed).spawn(n_chunks)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        means = numpy.concatenate(list(pool.map(bootstrap_worker, repeat(values), chunk_sizes, seeds)))
+
+    lower, upper = numpy.nanpercentile(means, [(1 - confidence) / 2 * 100, (1 + confidence) / 2 * 100], axis=0)
+    return pandas.DataFrame(
+        {"mean": numpy.nanmean(values, axis=0), "ci_lower": lower, "ci_upper": upper}, index=measures.columns
+    )
+
+
+# _____ INPUT SAMPLES _____ #
+def input_samples(path) -> tuple:
+    """
+    Samples of RPEP.InputSampler, without loading them into memory
+    :param path: Samples (.npy)
+    :return: list of memory-mapped structured arrays in the order they were sampled (two when the ring buffer wrapped
+             around, else one), dictionary of codes (inputs, block_types, phases, sample_rate)
+    """
+    samples = numpy.load(path, mmap_mode="r")
+    with open(path.rsplit(".", 1)[0] + ".json", "r", encoding="utf-8") as file:
+        codes = json.load(file)
+    numbers = samples["sample"]
+    if numbers[-1]:
+        oldest = int(numpy.argmin(numbers))
+        return [samples[oldest:], samples[:oldest]], codes
+    return [samples[:int(numpy.argmin(numbers))] if not numbers.all() else samples], codes
+
+
+def presses(path, name="space"):
+    """
+    Every press of an input (with its release) in the samples of a session
+    :param path: Samples (.npy)
+    :param name: Input: space, escape or click
+    :return: DataFrame (columns block_type, trial_nr, phase, down, up: times of the first samples with the input held
+             down and released; up is NaN if the session ended while held down)
+    """
+    segments, codes = input_samples(path)
+    columns = {column: numpy.concatenate([segment[column] for segment in segments]) for column in ("time", "block_type", "trial_nr", "phase", "pressed")}
+    held = (columns["pressed"] & codes["inputs"][name]).astype(bool)
+    change = numpy.diff(held.astype(numpy.int8), prepend=0, append=0)
+    down, up = numpy.flatnonzero(change == 1), numpy.flatnonzero(change == -1)
+    block_types, phases = numpy.array(codes["block_types"] + [None]), numpy.array(codes["phases"] + [None])
+    return pandas.DataFrame({
+        "block_type": block_types[columns["block_type"][down]],  # -1 (outside the trials) -> None
+        "trial_nr": columns["trial_nr"][down],
+        "phase": phases[columns["phase"][down]],
+        "down": columns["time"][down],
+        "up": numpy.append(columns["time"], numpy.nan)[up],
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Group-level Pavlovian bias analysis")
+    parser.add_argument("--store", default=os.path.join(os.getcwd(), "RPEP_store"), help="Store of RPEP_consolidate")
+    parser.add_argument("--source", default="experiment", help="experiment, developer_mode, dry_run or simulated")
+    parser.add_argument("--resamples", type=int, default=10000)
+    parser.add_argument("--workers", type=int, default=None)
+    arguments = parser.parse_args()
+
+    from RPEP_consolidate import query
+    all_trials = prepare(query(arguments.store, sources=[arguments.source]).sort_values(["participant_nr", "session_file", "trial_nr"], kind="stable"))
+    print(bootstrap_ci(participant_measures(all_trials), n_resamples=arguments.resamples, workers=arguments.workers).to_string())
@@ -0,0 +1,231 @@
+"""
+--------------------------
+
+Benchmarks of the hot paths of RPEP.py (draw_stimuli, communication, trial_maker, outcome_handler, Questionnaire.ask and
+a short trial_runner) on the virtual clock of the dry run, so nothing waits for the screen.
+
+With a display, the stimuli are drawn on a real psychopy window (OffscreenBackend): draws, text layout and flips go
+through OpenGL. On a Linux box without GPU or screen, run it under Xvfb with Mesa (software rendering, llvmpipe):
+    xvfb-run -s "-screen 0 1920x1080x24" python RPEP_benchmark.py
+Without a display, the stub window of the dry run draws nothing: those numbers are only the python overhead of every path.
+
+Reports the latency distribution per call and the memory allocated per call (tracemalloc, separate run). Results can be
+saved as a baseline and later runs compared to it (only with the same kind of window).
+
+--------------------------
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import tracemalloc
+from itertools import cycle
+from RPEP import Exp, DryRunBackend, RandomResponder
+
+FIX_CROSS_DURATION = [750, 1250]
+WINDOW_SIZE = (1920, 1080)
+
+
+class OffscreenBackend(DryRunBackend):
+    """
+    Dry run (virtual clock, random responses) on a real psychopy window: stimuli are drawn by OpenGL, flips do not wait
+    for the screen
+    """
+    def make_window(self, fullscr: bool):
+        from psychopy import visual
+        self.visual = visual
+        window = visual.Window(size=WINDOW_SIZE, units="norm", fullscr=False, waitBlanking=False)
+        flip = window.flip
+
+        def virtual_flip(clearBuffer=True):
+            # As HeadlessWindow: one frame of virtual time, the functions of callOnFlip see the time of the new frame
+            self.now += 1 / self.refresh_rate
+            flip(clearBuffer)
+            return self.now
+        window.flip = virtual_flip
+        return window
+
+
+def display_available() -> bool:
+    # Linux needs an X server (a screen, or Xvfb) for a psychopy window
+    return not sys.platform.startswith("linux") or bool(os.environ.get("DISPLAY"))
+
+
+def setup(seed=0, window="stub") -> Exp:
+    """
+    :param seed: Seed of the trial schedules and of the responder
+    :param window: "real" (psychopy window, OffscreenBackend) or "stub" (dry run: draws nothing)
+    :return: Exp on the virtual clock, without datafile
+    """
+    backend = (OffscreenBackend if window == "real" else DryRunBackend)(responder=RandomResponder(seed=seed))
+    return Exp(bowl_size=0.5, save_directory=None, devstats=False, backend=backend, schedule_seed=seed)
+
+
+def block_maker(exp, n_trials: int):
+    """
+    trial_maker uses up 2 of the shapes and colors of Exp per block: the returned function restores them every time
+    :param exp: Exp of setup()
+    :param n_trials: Amount of trials per block
+    :return: function that returns the result of trial_maker (shapes, colors, trials)
+    """
+    shape_names, all_colors = list(exp.shape_names), list(exp.all_colors)
+
+    def make_block():
+        exp.shape_names, exp.all_colors = list(shape_names), list(all_colors)
+        return exp.trial_maker(n_trials, FIX_CROSS_DURATION, block_type="congruent")
+    return make_block
+
+
+# _____ BENCHMARKS _____ #
+# Name -> function that prepares an Exp and returns the call to measure
+def draw_stimuli(exp):
+    shapes, colors, trials = block_maker(exp, 16)()
+    trial = trials[0]
+    return lambda: exp.draw_stimuli(trial, garnish=True, bowl_action=True)
+
+
+def communication(exp):
+    shapes, colors, trials = block_maker(exp, 16)()
+    return lambda: exp.communication("general", n_block=0, colors=colors, wait_resp=False)
+
+
+def trial_maker(exp):
+    return block_maker(exp, 160)
+
+
+def outcome_handler(exp):
+    shapes, colors, trials = block_maker(exp, 160)()
+    response_times = [exp.backend.responder.trial_response() for _ in trials]
+    responses = cycle([(trial, "space" if rt else None, rt) for trial, rt in zip(trials, response_times)])
+
+    def call():
+        trial, response, response_time = next(responses)
+        exp.outcome_handler(trial, response, response_time)
+    return call
+
+
+def questionnaire(exp):
+    shapes, colors, trials = block_maker(exp, 16)()
+    return lambda: exp.questionnaire.ask(correct_answers=[colors[1], shapes[0], "congruent"], block_type="congruent")
+
+
+def trial_runner(exp):
+    make_block = block_maker(exp, 8)
+
+    def call():
+        shapes, colors, trials = make_block()
+        exp.trial_runner(trials, feedback_duration=1.5, response_deadline=1, intertrial_interval=0.5, times_instructions_read=1)
+    return call
+
+
+BENCHMARKS = {
+    "draw_stimuli": (draw_stimuli, 20000),
+    "communication": (communication, 5000),
+    "trial_maker": (trial_maker, 200),
+    "outcome_handler": (outcome_handler, 20000),
+    "questionnaire": (questionnaire, 2000),
+    "trial_runner_8_trials": (trial_runner, 50),
+}
+
+
+def measure(make_call, repeats: int, warmup=10, window="stub") -> dict:
+    """
+    Latency distribution and allocations of one benchmark
+    :param make_call: Function of BENCHMARKS
+    :param repeats: Amount of measured calls
+    :param warmup: Amount of calls before measuring (fills caches)
+    :param window: "real" or "stub" (see setup)
+    :return: dictionary of statistic -> value (latencies in µs, memory in bytes per call)
+    """
+    exp = setup(window=window)
+    call = make_call(exp)
+    for _ in range(warmup):
+        call()
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter_ns()
+        call()
+        latencies.append((time.perf_counter_ns() - start) / 1000)
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+
+    # Allocations in a separate run: tracemalloc slows every allocation down
+    n_traced = min(repeats, 1000)
+    tracemalloc.start()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    for _ in range(n_traced):
+        call()
+    end_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    exp.win.close()
+
+    return {
+        "window": window,
+        "calls": repeats,
+        "mean_us": statistics.fmean(latencies),
+        "min_us": min(latencies),
+        "median_us": statistics.median(latencies),
+        "p90_us": percentiles[89],
+        "p99_us": percentiles[98],
+        "max_us": max(latencies),
+        "retained_bytes_per_call": (end_memory - start_memory) / n_traced,
+        "peak_bytes": peak_memory - start_memory,
+    }
+
+
+def regressions(results: dict, baseline: dict, tolerance=0.25) -> list:
+    """
+    Compares benchmark results to a baseline (median and p90 latency, retained memory)
+    :param results: dictionary of benchmark -> result of measure()
+    :param baseline: Earlier results
+    :param tolerance: Allowed increase (fraction of the baseline)
+    :return: list of problems (empty if none)
+    """
+    problems = []
+    for name, result in results.items():
+        # A stub window (python overhead only) is not compared to a real one
+        if name not in baseline or baseline[name].get("window", "stub") != result["window"]:
+            continue
+        for statistic in ("median_us", "p90_us", "retained_bytes_per_call"):
+            # Small absolute differences (< 1 µs or 64 bytes) are noise
+            margin = 1 if statistic.endswith("_us") else 64
+            if result[statistic] > baseline[name][statistic] * (1 + tolerance) + margin:
+                problems.append(f"{name} {statistic}: {result[statistic]:.1f} (baseline {baseline[name][statistic]:.1f})")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of RPEP.py on the virtual clock of the dry run")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS), help="Benchmarks to run (default: all)")
+    parser.add_argument("--window", choices=["auto", "real", "stub"], default="auto",
+                        help="real: psychopy window (needs a display, e.g. xvfb-run), stub: python overhead only, auto: real if possible")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplies the amount of calls per benchmark")
+    parser.add_argument("--baseline", default=os.path.join(os.getcwd(), "RPEP_benchmark_baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="Save this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown compared to the baseline")
+    arguments = parser.parse_args()
+
+    window_kind = arguments.window
+    if window_kind == "auto":
+        window_kind = "real" if display_available() else "stub"
+    print("Window: psychopy (rendering included)" if window_kind == "real" else
+          "Window: stub, no display (python overhead only, nothing is rendered)")
+
+    all_results = {}
+    print(f"{'benchmark':24s} {'median':>10} {'p90':>10} {'p99':>10} {'max':>10} {'retained':>10} {'peak':>10}")
+    for benchmark in arguments.benchmarks:
+        make, n_calls = BENCHMARKS[benchmark]
+        result = all_results[benchmark] = measure(make, max(2, round(n_calls * arguments.scale)), window=window_kind)
+        print(f"{benchmark:24s} {result['median_us']:8.1f}µs {result['p90_us']:8.1f}µs {result['p99_us']:8.1f}µs "
+              f"{result['max_us']:8.1f}µs {result['retained_bytes_per_call']:9.0f}B {result['peak_bytes']:9.0f}B")
+
+    if arguments.save_baseline:
+        with open(arguments.baseline, "w", encoding="utf-8") as file:
+            json.dump(all_results, file, indent=1)
+    elif os.path.exists(arguments.baseline):
+        with open(arguments.baseline, "r", encoding="utf-8") as file:
+            found = regressions(all_results, json.load(file), arguments.tolerance)
+        print("\n".join(["Slower than baseline:"] + found) if found else "No regressions compared to the baseline")
+        sys.exit(1 if found else 0)
@@ -0,0 +1,186 @@
+"""
+--------------------------
+
+Consolidates the datafiles of all sessions of RPEP.py into one columnar dataset (parquet, partitioned by participant
+and block type) with typed columns, for cross-participant analysis
+
+Only new or changed datafiles are loaded when run again. Developer_mode, Dry_run and Simulated files are included, but
+flagged in the "source" column (and left out of queries by default).
+
+Requires pyarrow.
+
+--------------------------
+"""
+import os
+import glob
+import json
+import hashlib
+import argparse
+import pandas
+import pyarrow
+import pyarrow.dataset
+import pyarrow.parquet
+from RPEP import read_session
+
+# Column -> type in the store (missing columns are empty)
+COLUMN_TYPES = {
+    "participant_nr": "string",
+    "block_type": "string",
+    "trial_nr": "Int16",
+    "shape_name": "category",
+    "correct_response": "category",
+    "color": "category",
+    "incentive": "category",
+    "fix_cross_frames": "Int16",
+    "order_per_8": "Int8",
+    "given_response": "category",
+    "accuracy": "Int8",
+    "feedback": "Int8",
+    "response_time": "float64",
+    "times_instructions_read": "Int16",
+    "stimulus_onset": "float64",
+    "keypress_time": "float64",
+    **{f"{phase}_frames_{kind}": "Int16" for phase in ("iti", "fixation", "stimulus", "feedback") for kind in ("intended", "achieved")},
+    "dropped_frames": "Int16",
+    "longest_frame": "float64",
+    "timing_ok": "Int8",
+    "participant_gender": "category",
+    "participant_age": "Int16",
+    "colorblind": "Int8",
+    "source": "category",  # experiment/developer_mode/dry_run/simulated
+    "complete": "boolean",  # Session was completed
+    "session_file": "string",  # Absolute path of the datafile (every lab PC has its own data_<nr>.csv)
+}
+PARTITIONING = pyarrow.dataset.partitioning(
+    pyarrow.schema([("participant_nr", pyarrow.string()), ("block_type", pyarrow.string())]), flavor="hive"
+)
+
+
+def read_datafile(path):
+    """
+    Reads the datafile of one session: DataWriter files (csv/jsonl) and older data.ExperimentHandler csv files
+    :param path: Absolute path of the datafile
+    :return: DataFrame with one row per trial (with the session header as columns)
+    """
+    name = os.path.basename(path)
+    with open(path, "r", encoding="utf-8") as file:
+        first_line = file.readline()
+
+    if path.endswith(".jsonl") or first_line.startswith("# "):
+        header, rows, complete = read_session(path)
+        frame = pandas.DataFrame(rows).assign(**header)
+    else:
+        # ExperimentHandler: participant info on every row, plus its own bookkeeping columns
+        frame = pandas.read_csv(path)
+        frame = frame.loc[:, [column for column in frame.columns if column in COLUMN_TYPES]]
+        complete = True
+
+    if "Developer_mode" in name:
+        source = "developer_mode"
+    elif "Dry_run" in name:
+        source = "dry_run"
+    elif "Simulated" in name:
+        source = "simulated"
+    else:
+        source = "experiment"
+    return frame.assign(source=source, complete=complete, session_file=path)
+
+
+def typed(frame):
+    """
+    Converts a DataFrame to the columns and types of the store
+    :param frame: DataFrame of read_datafile
+    :return: DataFrame with exactly the columns of COLUMN_TYPES
+    """
+    frame = frame.reindex(columns=list(COLUMN_TYPES))
+    for column, column_type in COLUMN_TYPES.items():
+        values = frame[column].replace("", None)
+        if column_type.startswith("Int") or column_type == "float64":
+            values = pandas.to_numeric(values, errors="coerce")
+        frame[column] = values.astype(column_type)
+    return frame
+
+
+def consolidate(data_directories, store) -> list:
+    """
+    Adds new and changed datafiles to the store (a manifest keeps track of the loaded files)
+    :param data_directories: Directories with datafiles (data_*.csv / data_*.jsonl)
+    :param store: Directory of the store
+    :return: list of the loaded datafiles
+    """
+    os.makedirs(store, exist_ok=True)
+    manifest_path = os.path.join(store, "_manifest.json")  # Files starting with "_" are ignored by pyarrow
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+
+    paths = sorted(
+        os.path.abspath(path) for directory in data_directories for extension in ("csv", "jsonl")
+        for path in glob.glob(os.path.join(directory, f"data_*.{extension}"))
+    )
+    loaded = []
+    for path in paths:
+        version = [os.path.getmtime(path), os.path.getsize(path)]
+        if manifest.get(path) == version:
+            continue
+
+        # Changed (e.g. resumed) session: replace its earlier version. The name of its parts includes a hash of the path:
+        # datafiles of different directories may have the same name
+        stem = os.path.basename(path).replace(".", "_") + "_" + hashlib.sha1(path.encode("utf-8")).hexdigest()[:12]
+        for old_part in glob.glob(os.path.join(store, "*", "*", f"{stem}-*.parquet")):
+            os.remove(old_part)
+
+        frame = typed(read_datafile(path))
+        if len(frame):
+            pyarrow.parquet.write_to_dataset(
+                pyarrow.Table.from_pandas(frame, preserve_index=False), store,
+                partition_cols=["participant_nr", "block_type"], basename_template=f"{stem}-{{i}}.parquet",
+                existing_data_behavior="overwrite_or_ignore"
+            )
+
+        # Save the manifest after every file: an interrupted run continues where it stopped
+        manifest[path] = version
+        with open(manifest_path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=1)
+        loaded.append(path)
+    return loaded
+
+
+def query(store, columns=None, sources=("experiment",), complete_only=True, **selection):
+    """
+    Loads a slice of the store; only the partitions and row groups that match are read
+    :param store: Directory of the store
+    :param columns: Columns to load (default: all)
+    :param sources: Sources to include (experiment, developer_mode, dry_run, simulated)
+    :param complete_only: Leave out sessions that were not completed
+    :param selection: column=value or column=[values], e.g. incentive="reward", block_type="congruent", participant_nr=["1", "2"]
+    :return: DataFrame
+    """
+    dataset = pyarrow.dataset.dataset(store, format="parquet", partitioning=PARTITIONING)
+    expression = pyarrow.dataset.field("source").isin(list(sources))
+    if complete_only:
+        expression &= pyarrow.dataset.field("complete")
+    for column, values in selection.items():
+        values = [values] if isinstance(values, (str, int)) else list(values)
+        expression &= pyarrow.dataset.field(column).isin(values)
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def accuracy_table(store, **selection):
+    """
+    Accuracy and amount of trials per incentive x correct_response x block_type (see query() for the selection)
+    :return: DataFrame
+    """
+    trials = query(store, columns=["incentive", "correct_response", "block_type", "accuracy"], **selection)
+    return trials.groupby(["incentive", "correct_response", "block_type"], observed=True)["accuracy"].agg(["mean", "count"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consolidate RPEP datafiles into one parquet store")
+    parser.add_argument("data_directories", nargs="*", default=[os.path.join(os.getcwd(), "RPEP_data")])
+    parser.add_argument("--store", default=os.path.join(os.getcwd(), "RPEP_store"))
+    arguments = parser.parse_args()
+
+    new_files = consolidate(arguments.data_directories, arguments.store)
+    print(f"Loaded {len(new_files)} new or changed datafile(s) into {arguments.store}")
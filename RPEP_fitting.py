@@ -0,0 +1,216 @@
+"""
+--------------------------
+
+Fits reinforcement-learning models of the Pavlovian bias (Guitart-Masip et al., 2012) to the trials of RPEP.py
+
+Every participant gets their own parameters (maximum likelihood). The trial likelihoods are computed for a whole group
+of participants at once (numpy arrays: participants x trials), the random starts of the optimisation run in a process
+pool. The models learn from the logged feedback (+10/+1/-1/-10), so they follow whatever outcome_handler gave.
+
+Models are compared with the BIC and with leave-one-block-out prediction: parameters are fitted on one block and the
+other block (new stimuli, same participant) is predicted.
+
+--------------------------
+"""
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import pandas
+from scipy.optimize import minimize
+from scipy.special import expit
+
+# Model -> parameters
+MODELS = {
+    "rw": ["learning_rate", "sensitivity", "noise"],
+    "rw_go_bias": ["learning_rate", "sensitivity", "noise", "go_bias"],
+    "rw_go_bias_pavlovian": ["learning_rate", "sensitivity", "noise", "go_bias", "pavlovian_weight"],
+}
+# Parameter -> transformation from the (unbounded) fitting scale to the model scale
+TRANSFORMS = {
+    "learning_rate": expit,
+    "sensitivity": numpy.exp,
+    "noise": expit,
+    "go_bias": lambda x: x,
+    "pavlovian_weight": numpy.exp,
+}
+
+
+def trial_arrays(trials) -> dict:
+    """
+    Converts trials to arrays of participants x trials (shorter sessions are padded and masked)
+    :param trials: DataFrame with participant_nr, block_type, shape_name, color, given_response, feedback (in presented order)
+    :return: dictionary of arrays (stimulus, go, outcome, block, valid) and the participant numbers
+    """
+    trials = trials.sort_values("participant_nr", kind="stable")
+    participant = pandas.factorize(trials["participant_nr"])[0]
+    # Stimulus number within participant (4 stimuli per block, blocks have different stimuli)
+    stimulus = pandas.factorize(pandas.MultiIndex.from_arrays(
+        [trials["participant_nr"], trials["block_type"], trials["shape_name"], trials["color"]]
+    ))[0]
+    stimulus -= pandas.Series(stimulus).groupby(participant).transform("min").to_numpy()
+    position = trials.groupby(participant).cumcount().to_numpy()
+
+    shape = (participant.max() + 1, position.max() + 1)
+    arrays = {"valid": numpy.zeros(shape, dtype=bool), "stimulus": numpy.zeros(shape, dtype=int),
+              "go": numpy.zeros(shape, dtype=bool), "outcome": numpy.zeros(shape), "block": numpy.zeros(shape, dtype=int)}
+    arrays["valid"][participant, position] = True
+    arrays["stimulus"][participant, position] = stimulus
+    arrays["go"][participant, position] = (trials["given_response"] == "Go").to_numpy()
+    arrays["outcome"][participant, position] = pandas.to_numeric(trials["feedback"]).to_numpy() / 10
+    arrays["block"][participant, position] = (trials["block_type"] == "incongruent").to_numpy()
+    arrays["participant_nr"] = pandas.unique(trials["participant_nr"])
+    return arrays
+
+
+def chunk_arrays(arrays: dict, indices) -> dict:
+    return {name: values[indices] for name, values in arrays.items()}
+
+
+def negative_log_likelihood(params, arrays: dict, model: str, mask=None):
+    """
+    Negative log likelihood of every participant's responses
+    :param params: Array (participants x parameters of the model) on the fitting scale
+    :param arrays: Result of trial_arrays (same participants)
+    :param model: Name of the model (key of MODELS)
+    :param mask: Trials that count for the likelihood (default: all); learning always uses all trials
+    :return: Array (participants)
+    """
+    values = {name: TRANSFORMS[name](params[:, i]) for i, name in enumerate(MODELS[model])}
+    go_bias = values.get("go_bias", 0)
+    pavlovian_weight = values.get("pavlovian_weight", 0)
+    mask = arrays["valid"] if mask is None else mask
+
+    n_participants, n_trials = arrays["valid"].shape
+    participants = numpy.arange(n_participants)
+    q = numpy.zeros((n_participants, arrays["stimulus"].max() + 1, 2))  # Action values (NoGo, Go)
+    v = numpy.zeros((n_participants, arrays["stimulus"].max() + 1))  # Stimulus (Pavlovian) values
+    nll = numpy.zeros(n_participants)
+    for t in range(n_trials):
+        stimulus, go, valid = arrays["stimulus"][:, t], arrays["go"][:, t], arrays["valid"][:, t]
+        weight_go = q[participants, stimulus, 1] + go_bias + pavlovian_weight * v[participants, stimulus]
+        p_go = (1 - values["noise"]) * expit(weight_go - q[participants, stimulus, 0]) + values["noise"] / 2
+        nll -= mask[:, t] * numpy.log(numpy.where(go, p_go, 1 - p_go) + 1e-12)
+
+        outcome = values["sensitivity"] * arrays["outcome"][:, t]
+        action = go.astype(int)
+        q[participants, stimulus, action] += valid * values["learning_rate"] * (outcome - q[participants, stimulus, action])
+        v[participants, stimulus] += valid * values["learning_rate"] * (outcome - v[participants, stimulus])
+    return nll
+
+
+def fit_chunk(arrays: dict, model: str, start, mask=None) -> tuple:
+    """
+    Fits one start for a chunk of participants. The participants are independent, so the summed likelihood is
+    optimised at once and its gradient (forward differences) needs only one vectorised pass over the trials
+    :param arrays: Result of trial_arrays (chunk of participants)
+    :param model: Name of the model
+    :param start: Array (participants x parameters), start values on the fitting scale
+    :param mask: Trials that count for the likelihood (default: all)
+    :return: fitted parameters (fitting scale), negative log likelihood per participant
+    """
+    n_participants, n_params = start.shape
+    step = 1e-5
+    mask = arrays["valid"] if mask is None else mask
+    # The parameters and their (parameters) shifted copies are evaluated in one pass over the trials
+    stacked_arrays = {name: numpy.tile(values, (n_params + 1,) + (1,) * (values.ndim - 1)) for name, values in arrays.items()}
+    stacked_mask = numpy.tile(mask, (n_params + 1, 1))
+    shifts = numpy.vstack([numpy.zeros(n_params), step * numpy.eye(n_params)])
+
+    def objective(flat_params):
+        params = flat_params.reshape(n_participants, n_params)
+        stacked_params = (params[numpy.newaxis] + shifts[:, numpy.newaxis]).reshape(-1, n_params)
+        nll = negative_log_likelihood(stacked_params, stacked_arrays, model, stacked_mask).reshape(n_params + 1, n_participants)
+        gradient = (nll[1:] - nll[0]).T / step
+        return nll[0].sum(), gradient.ravel()
+
+    result = minimize(objective, start.ravel(), jac=True, method="L-BFGS-B", bounds=[(-8, 8)] * start.size)
+    params = result.x.reshape(n_participants, n_params)
+    return params, negative_log_likelihood(params, arrays, model, mask)
+
+
+def fit(arrays: dict, model: str, mask=None, n_starts=10, chunk_size=64, workers=None, seed=0) -> tuple:
+    """
+    Multi-start fit of every participant (process pool over chunks of participants x starts)
+    :param arrays: Result of trial_arrays
+    :param model: Name of the model
+    :param mask: Trials that count for the likelihood (default: all)
+    :param n_starts: Random starts per participant (best one is kept)
+    :param chunk_size: Participants per optimisation
+    :param workers: Amount of worker processes (default: amount of cores)
+    :param seed: Seed of the start values
+    :return: best parameters (fitting scale, participants x parameters), their negative log likelihood
+    """
+    n_participants = len(arrays["participant_nr"])
+    n_params = len(MODELS[model])
+    generator = numpy.random.default_rng(seed)
+    starts = generator.normal(0, 1, size=(n_starts, n_participants, n_params))
+    chunks = [numpy.arange(begin, min(begin + chunk_size, n_participants)) for begin in range(0, n_participants, chunk_size)]
+    mask = arrays["valid"] if mask is None else mask
+
+    best_params = numpy.zeros((n_participants, n_params))
+    best_nll = numpy.full(n_participants, numpy.inf)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = {
+            pool.submit(fit_chunk, chunk_arrays(arrays, indices), model, starts[start][indices], mask[indices]): indices
+            for indices in chunks for start in range(n_starts)
+        }
+        for job, indices in jobs.items():
+            params, nll = job.result()
+            better = nll < best_nll[indices]
+            best_params[indices[better]] = params[better]
+            best_nll[indices[better]] = nll[better]
+    return best_params, best_nll
+
+
+def fit_models(trials, models=tuple(MODELS), n_starts=10, workers=None, seed=0) -> tuple:
+    """
+    Fits every model to every participant, with BIC and leave-one-block-out prediction
+    :param trials: DataFrame with trials (see trial_arrays)
+    :param models: Names of the models to fit
+    :param n_starts: Random starts per participant
+    :param workers: Amount of worker processes (default: amount of cores)
+    :param seed: Seed of the start values
+    :return: DataFrame per participant x model (parameters, nll, bic, loo_nll), DataFrame with the model comparison
+    """
+    arrays = trial_arrays(trials)
+    n_trials = arrays["valid"].sum(axis=1)
+    fits = []
+    for model in models:
+        params, nll = fit(arrays, model, n_starts=n_starts, workers=workers, seed=seed)
+        result = pandas.DataFrame(
+            {name: TRANSFORMS[name](params[:, i]) for i, name in enumerate(MODELS[model])}, index=arrays["participant_nr"]
+        )
+        result["model"] = model
+        result["nll"] = nll
+        result["bic"] = 2 * nll + len(MODELS[model]) * numpy.log(n_trials)
+
+        # Leave one block out: fit on one block, predict the other
+        result["loo_nll"] = 0.0
+        for held_out in (0, 1):
+            fitted, _ = fit(arrays, model, mask=arrays["valid"] & (arrays["block"] != held_out), n_starts=n_starts,
+                            workers=workers, seed=seed)
+            result["loo_nll"] += negative_log_likelihood(fitted, arrays, model, arrays["valid"] & (arrays["block"] == held_out))
+        fits.append(result)
+
+    fits = pandas.concat(fits).rename_axis("participant_nr").reset_index()
+    comparison = fits.groupby("model")[["nll", "bic", "loo_nll"]].sum()
+    comparison["best_bic_participants"] = fits.loc[fits.groupby("participant_nr")["bic"].idxmin(), "model"].value_counts()
+    comparison = comparison.fillna(0).sort_values("bic")
+    return fits, comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit Pavlovian bias RL models to RPEP data")
+    parser.add_argument("--store", default=os.path.join(os.getcwd(), "RPEP_store"), help="Store of RPEP_consolidate")
+    parser.add_argument("--source", default="experiment", help="experiment, developer_mode, dry_run or simulated")
+    parser.add_argument("--starts", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default=os.path.join(os.getcwd(), "RPEP_fits.csv"))
+    arguments = parser.parse_args()
+
+    from RPEP_consolidate import query
+    all_trials = query(arguments.store, sources=[arguments.source]).sort_values(["participant_nr", "session_file", "trial_nr"], kind="stable")
+    participant_fits, model_comparison = fit_models(all_trials, n_starts=arguments.starts, workers=arguments.workers)
+    participant_fits.to_csv(arguments.output, index=False)
+    print(model_comparison.to_string())
@@ -0,0 +1,51 @@
+"""
+--------------------------
+
+Live monitor of a developer mode session of RPEP.py
+
+In developer mode (devstats=True), Exp keeps running statistics per trial (OnlineStats: accuracy per cell, Go bias,
+response times) and writes them next to the datafile as <datafile>_stats.jsonl, on a background thread. This script runs
+in a second terminal/process and prints them readable as they come in, so nothing is printed inside the timed trial loop.
+
+--------------------------
+"""
+import os
+import json
+import time
+import argparse
+from RPEP import format_stats
+
+
+def follow(path, poll_interval=0.2):
+    """
+    Reads a JSON lines file that is still being written (waits for it to appear)
+    :param path: Path of the file
+    :param poll_interval: Time (s) between checks for new lines
+    :return: generator of entries (dictionaries)
+    """
+    while not os.path.exists(path):
+        time.sleep(poll_interval)
+    with open(path, "r", encoding="utf-8") as file:
+        line = ""
+        while True:
+            line += file.readline()
+            if not line.endswith("\n"):
+                time.sleep(poll_interval)  # Nothing new, or a line that is not completely written yet
+                continue
+            yield json.loads(line)
+            line = ""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Follow the running statistics of a developer mode session")
+    parser.add_argument("path", help="<datafile>_stats.jsonl")
+    parser.add_argument("--summary", action="store_true", help="Only print the latest statistics of the file and stop")
+    arguments = parser.parse_args()
+
+    if arguments.summary:
+        with open(arguments.path, "r", encoding="utf-8") as stats_file:
+            trials = [entry for entry in map(json.loads, stats_file) if entry["type"] == "trial"]
+        print(format_stats(trials[-1]) if trials else "No trials yet")
+    else:
+        for stats_entry in follow(arguments.path):
+            print(format_stats(stats_entry), flush=True)
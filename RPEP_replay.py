@@ -0,0 +1,76 @@
+"""
+--------------------------
+
+Replays a recorded session of RPEP.py (python RPEP.py --record saves <datafile>_replay.json.gz next to the datafile)
+
+The recording holds the seeds and settings of the session and every input it read (participant info, flip times, clock
+reads, keys, mouse, questionnaire clicks). The replay rebuilds Exp with the same settings and feeds the input back
+through trial_runner, Questionnaire.ask and communication without display and without waiting, so a 20 minute session
+is reproduced in seconds. The replayed datafile is compared to the original one: any difference means that the code no
+longer does the same with the same input (regression test), or shows exactly what the participant saw and did.
+
+--------------------------
+"""
+import os
+import sys
+import argparse
+import tempfile
+from RPEP import Exp, ReplayBackend
+
+
+def replay(path, save_directory):
+    """
+    Runs a recorded session again
+    :param path: Recording (.json.gz)
+    :param save_directory: Where to store the replayed datafile (prefix, as in Exp)
+    :return: Exp of the replay (data_writer.path is the replayed datafile)
+    """
+    backend = ReplayBackend(path)
+    settings = backend.settings
+    exp = Exp(bowl_size=settings["bowl_size"], save_directory=save_directory, devstats=settings["devstats"], backend=backend,
+              data_format=settings["data_format"], schedule_seed=settings["schedule_seed"])
+    try:
+        exp.main(**settings["main"])
+    except SystemExit:
+        pass  # The session was aborted (escape): replayed up to there
+    if exp.data_writer:
+        exp.data_writer.close()
+    return exp
+
+
+def compare(original, replayed) -> list:
+    """
+    :param original: Path of the datafile of the recorded session
+    :param replayed: Path of the datafile of the replay
+    :return: list of differing lines (line number, original, replayed); empty if identical
+    """
+    with open(original, "r", encoding="utf-8") as file:
+        original_lines = file.read().splitlines()
+    with open(replayed, "r", encoding="utf-8") as file:
+        replayed_lines = file.read().splitlines()
+    differences = [
+        (i + 1, original_line, replayed_line)
+        for i, (original_line, replayed_line) in enumerate(zip(original_lines, replayed_lines)) if original_line != replayed_line
+    ]
+    if len(original_lines) != len(replayed_lines):
+        differences.append((min(len(original_lines), len(replayed_lines)) + 1, f"{len(original_lines)} lines", f"{len(replayed_lines)} lines"))
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded RPEP session and compare the datafiles")
+    parser.add_argument("recording", help="<datafile>_replay.json.gz")
+    parser.add_argument("--output", default=None, help="Directory of the replayed datafile (default: temporary)")
+    parser.add_argument("--original", default=None, help="Datafile to compare with (default: next to the recording)")
+    arguments = parser.parse_args()
+
+    output = arguments.output or tempfile.mkdtemp(prefix="RPEP_replay_")
+    replayed_exp = replay(arguments.recording, os.path.join(output, "data_"))
+    original_path = arguments.original or arguments.recording[:-len("_replay.json.gz")] + "." + replayed_exp.data_writer.file_format
+    print(f"Replayed datafile: {replayed_exp.data_writer.path}")
+
+    found = compare(original_path, replayed_exp.data_writer.path)
+    for line_nr, original_line, replayed_line in found[:20]:
+        print(f"line {line_nr}:\n  original {original_line}\n  replayed {replayed_line}")
+    print(f"{len(found)} differing lines" if found else f"Identical to {original_path}")
+    sys.exit(1 if found else 0)
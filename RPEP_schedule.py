@@ -0,0 +1,196 @@
+"""
+--------------------------
+
+Trial schedules of RPEP.py: which stimulus comes when, and how long the fixation is shown
+
+A schedule is fully determined by the participant number and a seed. Every block consists of mini-blocks of 8 trials
+(each response x incentive combination twice, shuffled), generated as numpy arrays under constraints on the run length
+of the same incentive and of the same correct response (also across mini-blocks). The constraints are checked
+vectorised, so a library of validated schedules for thousands of participants can be pregenerated on multiple cores;
+Exp.trial_maker loads the schedule of its participant from it (or generates it if not in the library).
+
+--------------------------
+"""
+import os
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Position within the mini-block before shuffling (0-7) -> condition (position % 4): order of the original trial_maker
+RESPONSES = ["Go", "NoGo", "Go", "NoGo"]
+INCENTIVES = ["reward", "punishment", "punishment", "reward"]
+RESPONSE_CODE = numpy.array([0, 1, 0, 1])
+INCENTIVE_CODE = numpy.array([0, 1, 1, 0])
+MAX_RUN = 4  # Max amount of trials in a row with the same incentive / the same correct response
+N_CANDIDATES = 64  # Mini-blocks drawn at once when generating
+MAX_BATCHES = 1000  # Batches of candidates tried for one mini-block before giving up
+
+
+def run_too_long(codes, max_run: int):
+    """
+    :param codes: Array (..., trials) of incentive or response codes
+    :param max_run: Max run length
+    :return: Boolean array (...): True where more than max_run equal codes follow each other
+    """
+    same = codes[..., 1:] == codes[..., :-1]
+    if same.shape[-1] < max_run:
+        return numpy.zeros(same.shape[:-1], dtype=bool)
+    return sliding_window_view(same, max_run, axis=-1).all(axis=-1).any(axis=-1)
+
+
+def check_blocks(position, fix_cross_ms, fix_cross_duration, max_run=MAX_RUN):
+    """
+    Checks all constraints of any amount of blocks at once
+    :param position: Array (..., trials) of mini-block positions (0-7)
+    :param fix_cross_ms: Array (..., trials) of fixation durations (ms)
+    :param fix_cross_duration: Min and Max fixation duration (ms)
+    :param max_run: Max run length of the same incentive and of the same correct response
+    :return: Boolean array (...): True for valid blocks
+    """
+    mini_blocks = position.reshape(position.shape[:-1] + (-1, 8))
+    balanced = (numpy.sort(mini_blocks, axis=-1) == numpy.arange(8)).all(axis=(-2, -1))
+    condition = position % 4
+    return (
+        balanced
+        & ~run_too_long(INCENTIVE_CODE[condition], max_run)
+        & ~run_too_long(RESPONSE_CODE[condition], max_run)
+        & ((fix_cross_ms >= fix_cross_duration[0]) & (fix_cross_ms <= fix_cross_duration[1])).all(axis=-1)
+    )
+
+
+def block_schedule(generator, n_trials: int, fix_cross_duration, max_run=MAX_RUN) -> tuple:
+    """
+    Generates one block, mini-block by mini-block: of a batch of shuffled candidates, the first one that keeps the runs
+    (together with the end of the previous mini-block) short enough is kept
+    :param generator: numpy Generator
+    :param n_trials: Amount of trials (must be divisible by 8)
+    :param fix_cross_duration: Min and Max fixation duration (ms)
+    :param max_run: Max run length of the same incentive and of the same correct response
+    :return: array of mini-block positions, array of fixation durations (ms)
+    """
+    position = numpy.empty(0, dtype=numpy.int8)
+    n_batches = 0
+    while len(position) < n_trials:
+        n_batches += 1
+        if n_batches > MAX_BATCHES:
+            raise ValueError(f"max_run={max_run}: no mini-block found (in {MAX_BATCHES * N_CANDIDATES} candidates) without longer "
+                             f"runs of the same incentive or of the same correct response")
+        candidates = generator.permuted(numpy.tile(numpy.arange(8, dtype=numpy.int8), (N_CANDIDATES, 1)), axis=1)
+        sequences = numpy.hstack([numpy.tile(position[-max_run:], (N_CANDIDATES, 1)), candidates])
+        condition = sequences % 4
+        valid = ~run_too_long(INCENTIVE_CODE[condition], max_run) & ~run_too_long(RESPONSE_CODE[condition], max_run)
+        if valid.any():
+            position = numpy.concatenate([position, candidates[valid.argmax()]])
+            n_batches = 0
+    fix_cross_ms = generator.integers(fix_cross_duration[0], fix_cross_duration[1], endpoint=True, size=n_trials, dtype=numpy.int16)
+    return position, fix_cross_ms
+
+
+def participant_schedule(participant_nr: int, n_trials: int, fix_cross_duration, seed=0, n_blocks=2, max_run=MAX_RUN) -> dict:
+    """
+    Schedule of one participant (same participant number and seed: same schedule)
+    :param participant_nr: Participant number
+    :param n_trials: Amount of trials per block (must be divisible by 8)
+    :param fix_cross_duration: Min and Max fixation duration (ms)
+    :param seed: Seed of the schedules (None: different every time)
+    :param n_blocks: Amount of blocks
+    :param max_run: Max run length of the same incentive and of the same correct response
+    :return: dictionary with color_order and shape_order (permutations of the 4 colors/shapes of Exp) and per block
+             (first dimension) position and fix_cross_ms
+    """
+    generator = numpy.random.default_rng(None if seed is None else [seed, participant_nr])
+    schedule = stimulus_order(generator)
+    blocks = [block_schedule(generator, n_trials, fix_cross_duration, max_run) for _ in range(n_blocks)]
+    schedule["position"] = numpy.stack([position for position, fix_cross_ms in blocks])
+    schedule["fix_cross_ms"] = numpy.stack([fix_cross_ms for position, fix_cross_ms in blocks])
+    return schedule
+
+
+def stimulus_order(generator) -> dict:
+    """
+    Order of the colors and shapes (first draws of the generator of a participant, so independent of the amount of trials)
+    :param generator: numpy Generator of participant_schedule
+    :return: dictionary with color_order and shape_order
+    """
+    return {"color_order": generator.permutation(4), "shape_order": generator.permutation(4)}
+
+
+def participant_stimulus_order(participant_nr: int, seed=0) -> dict:
+    """
+    Color and shape order of participant_schedule, without generating the blocks
+    :return: dictionary with color_order and shape_order
+    """
+    return stimulus_order(numpy.random.default_rng(None if seed is None else [seed, participant_nr]))
+
+
+# _____ LIBRARY _____ #
+def library_worker(participant_nrs, n_trials: int, fix_cross_duration, seed, max_run) -> dict:
+    schedules = [participant_schedule(nr, n_trials, fix_cross_duration, seed, max_run=max_run) for nr in participant_nrs]
+    return {name: numpy.stack([schedule[name] for schedule in schedules]) for name in schedules[0]}
+
+
+def make_library(path, participant_nrs, n_trials=160, fix_cross_duration=(750, 1250), seed=0, max_run=MAX_RUN,
+                 workers=None, chunk_size=250) -> dict:
+    """
+    Generates and validates the schedules of many participants in parallel and saves them in one .npz file
+    :param path: Path of the library
+    :param participant_nrs: Participant numbers
+    :param n_trials: Amount of trials per block
+    :param fix_cross_duration: Min and Max fixation duration (ms)
+    :param seed: Seed of the schedules (a library needs a fixed seed)
+    :param max_run: Max run length of the same incentive and of the same correct response
+    :param workers: Amount of worker processes (default: amount of cores)
+    :param chunk_size: Participants per task
+    :return: dictionary of arrays (first dimension: participant)
+    """
+    participant_nrs = list(participant_nrs)
+    chunks = [participant_nrs[start:start + chunk_size] for start in range(0, len(participant_nrs), chunk_size)]
+    worker = partial(library_worker, n_trials=n_trials, fix_cross_duration=fix_cross_duration, seed=seed, max_run=max_run)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(worker, chunks))
+    library = {name: numpy.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+    valid = check_blocks(library["position"], library["fix_cross_ms"], fix_cross_duration, max_run)
+    if not valid.all():
+        raise ValueError(f"Invalid schedules for participants {numpy.array(participant_nrs)[~valid.all(axis=1)]}")
+
+    library.update(participant_nr=numpy.array(participant_nrs), n_trials=n_trials, seed=seed, max_run=max_run,
+                   fix_cross_duration=numpy.array(fix_cross_duration))
+    numpy.savez(path, **library)
+    return library
+
+
+def library_schedule(path, participant_nr: int, n_trials: int, fix_cross_duration, seed, max_run=MAX_RUN):
+    """
+    Loads the schedule of one participant from a library
+    :return: dictionary (see participant_schedule), or None if the participant or these settings are not in the library
+    """
+    if not path or not os.path.exists(path):
+        return None
+    with numpy.load(path) as library:
+        settings_match = (
+            seed is not None and library["seed"] == seed and library["n_trials"] == n_trials and library["max_run"] == max_run
+            and (library["fix_cross_duration"] == numpy.array(fix_cross_duration)).all()
+        )
+        index = numpy.flatnonzero(library["participant_nr"] == participant_nr)
+        if not settings_match or not len(index):
+            return None
+        return {name: library[name][index[0]] for name in ("color_order", "shape_order", "position", "fix_cross_ms")}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pregenerate a library of validated RPEP trial schedules")
+    parser.add_argument("--participants", type=int, default=5000, help="Participant numbers 1 to this number")
+    parser.add_argument("--trials", type=int, default=160, help="Trials per block (must be divisible by 8)")
+    parser.add_argument("--fix-cross-duration", type=int, nargs=2, default=[750, 1250], help="Min and Max (ms)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-run", type=int, default=MAX_RUN)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default=os.path.join(os.getcwd(), "RPEP_schedules.npz"))
+    arguments = parser.parse_args()
+
+    make_library(arguments.output, range(1, arguments.participants + 1), arguments.trials, arguments.fix_cross_duration,
+                 arguments.seed, arguments.max_run, arguments.workers)
+    print(f"Saved the schedules of {arguments.participants} participants in {arguments.output}")
@@ -0,0 +1,212 @@
+"""
+--------------------------
+
+Simulated participants for the Go/NoGo task of RPEP.py
+
+Trials and their outcomes come from Exp.trial_maker and Exp.outcome_handler (dry-run backend, so no window is opened),
+responses come from an agent. Thousands of participants can be simulated in parallel, e.g. to choose the number of
+trials per block with a power analysis. Every participant gets a datafile like the experiment (DataWriter, named
+data_Simulated<nr>), so RPEP_consolidate and the analysis read them the same way.
+
+--------------------------
+"""
+import math
+import random
+import os
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import pandas
+from RPEP import Exp, DryRunBackend, DataWriter
+
+
+# _____ AGENTS _____ #
+class PavlovianAgent:
+    def __init__(self, go_bias=0.3, pavlovian_weight=0.5, learning_rate=0.2, noise=0.05, sensitivity=5.0,
+                 response_times=(0.45, 0.1), seed=None):
+        """
+        Q-learning Go/NoGo agent with a Go bias and a Pavlovian bias (Guitart-Masip et al., 2012)
+        :param go_bias: Added to the weight of Go (b)
+        :param pavlovian_weight: Weight of the stimulus value on Go (pi): more Go for reward, less Go for punishment stimuli
+        :param learning_rate: Learning rate of the action and stimulus values (epsilon)
+        :param noise: Irreducible noise (xi): probability of a random response
+        :param sensitivity: Feedback sensitivity (rho), feedback points are divided by 10 first
+        :param response_times: Mean and standard deviation (s) of the Go response times (normal, min 0.1 s)
+        :param seed: Seed of the random generator
+        """
+        self.go_bias = go_bias
+        self.pavlovian_weight = pavlovian_weight
+        self.learning_rate = learning_rate
+        self.noise = noise
+        self.sensitivity = sensitivity
+        self.response_times = response_times
+        self.random = random.Random(seed)
+
+        self.q = {}  # (stimulus, response) -> action value
+        self.v = {}  # stimulus -> stimulus (Pavlovian) value
+
+    def p_go(self, stimulus) -> float:
+        """
+        :param stimulus: Shape and color of the trial
+        :return: Probability of Go
+        """
+        go = self.q.get((stimulus, "Go"), 0) + self.go_bias + self.pavlovian_weight * self.v.get(stimulus, 0)
+        nogo = self.q.get((stimulus, "NoGo"), 0)
+        return (1 - self.noise) / (1 + math.exp(nogo - go)) + self.noise / 2
+
+    def respond(self, trial) -> tuple:
+        """
+        :param trial: trial (record of a TrialTable)
+        :return: response ("space" or None) and response time (None if NoGo)
+        """
+        if self.random.random() < self.p_go((trial["shape_name"], trial["color"])):
+            return "space", max(0.1, self.random.gauss(*self.response_times))
+        return None, None
+
+    def learn(self, trial, response, feedback_points) -> None:
+        """
+        Updates action and stimulus value with the received feedback (Rescorla-Wagner)
+        :param trial: trial (record of a TrialTable)
+        :param response: Given response ("space" or None)
+        :param feedback_points: Feedback of outcome_handler ("+10", "+1", "-1" or "-10")
+        :return: None
+        """
+        stimulus = (trial["shape_name"], trial["color"])
+        action = (stimulus, "Go" if response else "NoGo")
+        outcome = self.sensitivity * int(feedback_points) / 10
+        self.q[action] = self.q.get(action, 0) + self.learning_rate * (outcome - self.q.get(action, 0))
+        self.v[stimulus] = self.v.get(stimulus, 0) + self.learning_rate * (outcome - self.v.get(stimulus, 0))
+
+
+class RandomAgent:
+    def __init__(self, p_go=0.5, response_times=(0.45, 0.1), seed=None):
+        """
+        Responds at random, without learning (null model)
+        :param p_go: Probability of Go
+        :param response_times: Mean and standard deviation (s) of the Go response times (normal, min 0.1 s)
+        :param seed: Seed of the random generator
+        """
+        self.p_go = p_go
+        self.response_times = response_times
+        self.random = random.Random(seed)
+
+    def respond(self, trial) -> tuple:
+        if self.random.random() < self.p_go:
+            return "space", max(0.1, self.random.gauss(*self.response_times))
+        return None, None
+
+    def learn(self, trial, response, feedback_points) -> None:
+        pass
+
+
+# _____ SIMULATION _____ #
+def simulate_participant(participant_nr: int, seed=None, agent_class=PavlovianAgent, agent_params=None,
+                         n_trials_per_block=160, fix_cross_duration=(750, 1250), output=None) -> list:
+    """
+    Simulates both blocks of one participant (block order depends on the participant number, as in the experiment)
+    :param participant_nr: Participant number
+    :param seed: Seed of the agent and of the trial schedule (colors, shapes, trial order, fixation durations)
+    :param agent_class: Class of the agent (needs respond and learn, and a seed parameter)
+    :param agent_params: Parameters of the agent
+    :param n_trials_per_block: Total amount of trials per block (must be divisible by 8)
+    :param fix_cross_duration: Min and Max time (ms) during which the fixation cross is displayed
+    :param output: Directory of the datafile (None: no datafile)
+    :return: list of trials (dict column -> value), columns of the datafile of trial_runner (without timing) and header
+    """
+    agent = agent_class(seed=seed, **(agent_params or {}))
+    exp = Exp(
+        bowl_size=0.5, save_directory=None, devstats=False,
+        backend=DryRunBackend(participant_info=(str(participant_nr), "X/andere", "0", "Nee")), schedule_seed=seed
+    )
+
+    rows = []
+    for block_type in exp.blocks:
+        shapes, colors, trials = exp.trial_maker(n_trials_per_block, list(fix_cross_duration), block_type=block_type)
+        for i, trial in enumerate(trials):
+            response, response_time = agent.respond(trial)
+            accuracy, feedback_points, feedback_text = exp.outcome_handler(trial, response, response_time)
+            agent.learn(trial, response, feedback_points)
+            rows.append({"trial_nr": i, **trial, **exp.trial_data(trial, response, response_time, accuracy, feedback_points, 1)})
+
+    if output is not None:
+        # A new simulation replaces the datafile of an earlier one (DataWriter never overwrites a completed datafile)
+        file_name = os.path.join(output, f"data_Simulated{participant_nr}")
+        if os.path.exists(file_name + ".csv"):
+            os.remove(file_name + ".csv")
+        writer = DataWriter(file_name, header={**exp.participant_data(), "date": exp.backend.date(), "blocks": " ".join(exp.blocks)})
+        for row in rows:
+            writer.write(row)
+        writer.close(complete=True)
+    return [{**row, **exp.participant_data()} for row in rows]
+
+
+def simulate_cohort(n_participants: int, agent_class=PavlovianAgent, agent_params=None, n_trials_per_block=160,
+                    seed=0, workers=None, chunksize=16, output=None):
+    """
+    Simulates participants 1 to n_participants in parallel (process pool)
+    :param n_participants: Amount of participants
+    :param agent_class: Class of the agent (module level, so it can be sent to the worker processes)
+    :param agent_params: Parameters of the agent (same for every participant)
+    :param n_trials_per_block: Total amount of trials per block (must be divisible by 8)
+    :param seed: Participant i gets seed + i
+    :param workers: Amount of worker processes (default: amount of cores)
+    :param chunksize: Amount of participants sent to a worker at once
+    :param output: Directory of the datafiles (written by the workers; None: no datafiles)
+    :return: DataFrame with the trials of all participants
+    """
+    simulate = partial(simulate_participant, agent_class=agent_class, agent_params=agent_params,
+                       n_trials_per_block=n_trials_per_block, output=output)
+    participant_nrs = range(1, n_participants + 1)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        participants = pool.map(simulate, participant_nrs, [seed + nr for nr in participant_nrs], chunksize=chunksize)
+        return pandas.DataFrame([row for rows in participants for row in rows])
+
+
+def bias_statistics(trials) -> tuple:
+    """
+    Go bias (P(Go | reward) - P(Go | punishment)) and accuracy per participant and block type
+    :param trials: DataFrame with trials (simulated or collected)
+    :return: DataFrame per participant and block type, DataFrame with mean/sd/sem per block type
+    """
+    trials = trials.assign(go=trials["given_response"] == "Go")
+    p_go = trials.pivot_table(index=["participant_nr", "block_type"], columns="incentive", values="go", aggfunc="mean")
+    per_participant = pandas.DataFrame({
+        "p_go_reward": p_go["reward"],
+        "p_go_punishment": p_go["punishment"],
+        "go_bias": p_go["reward"] - p_go["punishment"],
+        "accuracy": trials.groupby(["participant_nr", "block_type"])["accuracy"].mean(),
+    })
+    aggregate = per_participant.groupby(level="block_type").agg(["mean", "std", "sem"])
+    return per_participant, aggregate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate participants with a Pavlovian-biased Q-learning agent")
+    parser.add_argument("--participants", type=int, default=1000)
+    parser.add_argument("--trials", type=int, default=160, help="Trials per block (must be divisible by 8)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: amount of cores)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--go-bias", type=float, default=0.3)
+    parser.add_argument("--pavlovian-weight", type=float, default=0.5)
+    parser.add_argument("--learning-rate", type=float, default=0.2)
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument("--sensitivity", type=float, default=5.0)
+    parser.add_argument("--output", default=os.path.join(os.getcwd(), "RPEP_simulation"))
+    arguments = parser.parse_args()
+
+    # Same datafile per participant as the experiment (written by the workers), plus the bias statistics
+    os.makedirs(arguments.output, exist_ok=True)
+    simulated_trials = simulate_cohort(
+        arguments.participants, n_trials_per_block=arguments.trials, seed=arguments.seed, workers=arguments.workers,
+        output=arguments.output, agent_params={
+            "go_bias": arguments.go_bias,
+            "pavlovian_weight": arguments.pavlovian_weight,
+            "learning_rate": arguments.learning_rate,
+            "noise": arguments.noise,
+            "sensitivity": arguments.sensitivity,
+        }
+    )
+    per_participant, aggregate = bias_statistics(simulated_trials)
+    per_participant.to_csv(os.path.join(arguments.output, "bias_per_participant.csv"))
+    aggregate.to_csv(os.path.join(arguments.output, "bias_aggregate.csv"))
+    print(aggregate)
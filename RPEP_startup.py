@@ -0,0 +1,111 @@
+"""
+--------------------------
+
+Cold start profile of RPEP.py
+
+Reports which imports take the time before the participant dialog appears (python -X importtime) and benchmarks the
+startup in a fresh interpreter per run: import of RPEP, import of the dialog, and the rest of Exp.__init__ (dry-run
+backend, so without window). The medians can be saved as a baseline and later runs compared to it, so a slower startup
+or a heavy module that is imported too early is caught.
+
+--------------------------
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Modules that should not be loaded by "import RPEP" (loaded later, where they are used)
+LAZY_MODULES = ["pandas", "numpy", "PIL", "psychopy.data", "psychopy.gui", "psychopy.visual", "psychopy.event", "pyglet.window"]
+BENCHMARK = f"""
+import sys, time, json
+start = time.perf_counter()
+import RPEP
+imported = time.perf_counter()
+eager = [module for module in {LAZY_MODULES!r} if module in sys.modules]
+from psychopy import gui
+dialog = time.perf_counter()
+RPEP.Exp(bowl_size=0.5, save_directory=None, devstats=False, backend=RPEP.DryRunBackend())
+ready = time.perf_counter()
+print(json.dumps({{"import": imported - start, "dialog": dialog - imported, "exp": ready - dialog, "eager": eager}}))
+"""
+
+
+def import_profile(module="RPEP", top=20) -> list:
+    """
+    Import times of a module and everything it imports (fresh interpreter)
+    :param module: Module to import
+    :param top: Amount of imports to return
+    :return: list of (cumulative ms, self ms, module name), slowest first
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=DIRECTORY,
+                             capture_output=True, text=True, check=True)
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative) / 1000, int(self_time) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def benchmark(repeats=5) -> dict:
+    """
+    Startup times (s) of RPEP in a fresh interpreter
+    :param repeats: Amount of runs (median is kept)
+    :return: dictionary of phase (total, import, dialog, exp) -> median time, and eager: lazy modules loaded by the import
+    """
+    runs = []
+    for _ in range(repeats):
+        process = subprocess.run([sys.executable, "-c", BENCHMARK], cwd=DIRECTORY, capture_output=True, text=True, check=True)
+        runs.append(json.loads(process.stdout.splitlines()[-1]))
+    result = {phase: statistics.median(run[phase] for run in runs) for phase in ("import", "dialog", "exp")}
+    result["total"] = sum(result.values())
+    result["eager"] = sorted({module for run in runs for module in run["eager"]})
+    return result
+
+
+def regressions(result: dict, baseline: dict, tolerance=0.25) -> list:
+    """
+    Compares a benchmark result to a baseline
+    :param result: Result of benchmark()
+    :param baseline: Earlier result of benchmark()
+    :param tolerance: Allowed slowdown (fraction of the baseline)
+    :return: list of problems (empty if none)
+    """
+    problems = [
+        f"{phase}: {result[phase]:.3f} s (baseline {baseline[phase]:.3f} s)"
+        for phase in ("import", "dialog", "exp", "total") if result[phase] > baseline[phase] * (1 + tolerance)
+    ]
+    problems += [f"{module} is imported by 'import RPEP'" for module in result["eager"] if module not in baseline["eager"]]
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import profile and startup benchmark of RPEP.py")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--baseline", default=os.path.join(os.getcwd(), "RPEP_startup_baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="Save this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown compared to the baseline")
+    arguments = parser.parse_args()
+
+    print(f"{'cumulative (ms)':>16} {'self (ms)':>10}  module")
+    for cumulative, self_time, name in import_profile():
+        print(f"{cumulative:16.1f} {self_time:10.1f}  {name}")
+
+    startup = benchmark(arguments.repeats)
+    print("\n" + "\n".join(f"{phase:>8}: {startup[phase]:.3f} s" for phase in ("import", "dialog", "exp", "total")))
+    if startup["eager"]:
+        print(f"Imported too early: {', '.join(startup['eager'])}")
+
+    if arguments.save_baseline:
+        with open(arguments.baseline, "w", encoding="utf-8") as file:
+            json.dump(startup, file, indent=1)
+    elif os.path.exists(arguments.baseline):
+        with open(arguments.baseline, "r", encoding="utf-8") as file:
+            found = regressions(startup, json.load(file), arguments.tolerance)
+        print("\n".join(["Slower than baseline:"] + found) if found else "No regressions compared to the baseline")
+        sys.exit(1 if found else 0)